@@ -7,11 +7,158 @@ Original file is located at
     https://colab.research.google.com/drive/1SXTaM6L4zyBzO4DUddqzm2yaYzRtQAUQ
 """
 
+import abc
+import contextlib
+import copy
+import functools
+import heapq
+import json
+import os
+import shutil
+import tempfile
+import time
+import argparse
 import numpy as np
-import matplotlib.pyplot as plt
+from collections import deque
 
-clean_dataset = np.loadtxt("wifi_db/clean_dataset.txt")
-noisy_dataset = np.loadtxt("wifi_db/noisy_dataset.txt")
+# matplotlib, asyncio, concurrent.futures, multiprocessing and the benchmark tools are imported by the
+# functions that use them, so importing this module for inference only loads numpy
+
+# dataset files, found relative to this file rather than the working directory
+DATASET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "wifi_db")
+CLEAN_DATASET_PATH = os.path.join(DATASET_DIR, "clean_dataset.txt")
+NOISY_DATASET_PATH = os.path.join(DATASET_DIR, "noisy_dataset.txt")
+
+# bytes of text parsed at a time by load_dataset
+LOAD_CHUNK_BYTES = 1 << 24
+
+# bytes that separate the values of a dataset file
+WHITESPACE_BYTES = np.frombuffer(b" \t\n\r\v\f", dtype=np.uint8)
+
+
+# number of whitespace delimited values on every line of a block of text, blank lines included
+# a value starts at every non-whitespace byte that follows whitespace or the start of the text
+# input:
+#   - text: bytes, ending with a newline
+# returns the count of each line
+def line_value_counts(text):
+    chars = np.frombuffer(text, dtype=np.uint8)
+    space = np.isin(chars, WHITESPACE_BYTES)
+    starts = ~space
+    starts[1:] &= space[:-1]
+    newlines = chars == ord("\n")
+    lines = np.cumsum(newlines) - newlines
+    return np.bincount(lines[starts], minlength=int(newlines.sum()))
+
+
+# parses a whitespace delimited dataset file chunk by chunk into a raw float64 stream
+# input:
+#   - path: text file, one sample per line
+#   - out: binary file object the parsed values are written to
+#   - chunk_bytes: bytes of text parsed at a time
+# returns number of rows and columns parsed
+def parse_dataset_chunks(path, out, chunk_bytes=LOAD_CHUNK_BYTES):
+    rows = 0
+    columns = None
+    remainder = b""
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(chunk_bytes)
+
+            # only parse up to the last complete line, carry the rest into the next chunk
+            text = remainder + block
+            if block:
+                cut = text.rfind(b"\n") + 1
+                text, remainder = text[:cut], text[cut:]
+            if not text.strip():
+                if not block:
+                    break
+                continue
+
+            # every non-blank line must have as many values as the first one
+            counts = line_value_counts(text if text.endswith(b"\n") else text + b"\n")
+            counts = counts[counts > 0]
+            if columns is None:
+                columns = int(counts[0])
+            if np.any(counts != columns):
+                raise ValueError(f"{path}: rows do not all have {columns} columns")
+            values = np.fromstring(text.decode("ascii"), sep=" ")
+            if values.size != counts.sum():
+                raise ValueError(f"{path}: could not parse every value as a number")
+            values.tofile(out)
+            rows += values.size // columns
+            if not block:
+                break
+    if columns is None:
+        raise ValueError(f"{path}: the dataset has no rows")
+    return rows, columns
+
+
+# loads a whitespace delimited dataset, e.g. the WiFi RSSI files in wifi_db
+# the text is parsed once in chunks and cached next to it as a .npy file, later loads
+# memory-map the cache instead of parsing again (copy-on-write, so changing the array never touches the file)
+# if the cache cannot be read or written, e.g. another user's cache or a read-only directory, the dataset is
+# loaded without it
+# input:
+#   - path: text file, one sample per line, label in the last column
+#   - cache: whether to read and write the .npy cache
+# returns the dataset as a 2-d float array
+def load_dataset(path, cache=True):
+    cache_path = path + ".npy"
+    if cache and os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        try:
+            return np.load(cache_path, mmap_mode="c")
+        except OSError:
+            pass
+
+    if cache:
+        try:
+            write_dataset_cache(path, cache_path)
+            return np.load(cache_path, mmap_mode="c")
+        except OSError:
+            pass
+
+    with tempfile.TemporaryFile() as raw:
+        rows, columns = parse_dataset_chunks(path, raw)
+        raw.seek(0)
+        return np.fromfile(raw).reshape(rows, columns)
+
+
+# parses a dataset file into its .npy cache, see load_dataset
+# the cache is written to a temporary file in the same directory and renamed into place once complete,
+# so concurrent loads never share scratch files and readers never see a half-written cache
+# mkstemp creates the file readable by its owner only, so it gets the usual permissions of a new file first
+# input:
+#   - path: text file of the dataset
+#   - cache_path: .npy file to write
+def write_dataset_cache(path, cache_path):
+    directory = os.path.dirname(os.path.abspath(cache_path))
+    fd, part_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(cache_path) + ".", suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out, tempfile.TemporaryFile(dir=directory) as raw:
+            rows, columns = parse_dataset_chunks(path, raw)
+
+            # prepend a .npy header to the raw values, never holding the whole dataset in memory
+            header = {"descr": "<f8", "fortran_order": False, "shape": (rows, columns)}
+            np.lib.format.write_array_header_1_0(out, header)
+            raw.seek(0)
+            shutil.copyfileobj(raw, out)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(part_path, 0o666 & ~umask)
+        os.replace(part_path, cache_path)
+    except BaseException:
+        os.remove(part_path)
+        raise
+
+
+# the two bundled datasets are loaded on first use, e.g. source_code.clean_dataset
+def __getattr__(name):
+    paths = {"clean_dataset": CLEAN_DATASET_PATH, "noisy_dataset": NOISY_DATASET_PATH}
+    if name not in paths:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = load_dataset(paths[name])
+    return globals()[name]
 
 # each node in the decision tree will be modelled as an object using OOP
 # each instantiated node will either be a decision node, or a leaf node.
@@ -22,14 +169,150 @@ noisy_dataset = np.loadtxt("wifi_db/noisy_dataset.txt")
 #   4. the left child
 #   5. the right child
 #   6. A class label, if leaf node only
+#   7. hashmap from label -> count of the training examples that reach the node, recorded by the builders
+#   8. sufficient statistics of a leaf of an IncrementalTree, (bins x classes) counts over the bins of every feature
 class Node:
-    def __init__(self, feature, split_val, depth, left = None, right = None, label = None):
+    def __init__(self, feature, split_val, depth, left = None, right = None, label = None, class_counts = None, stats = None):
         self.feature = feature
         self.split_val = split_val
         self.left = left
         self.right = right
         self.depth = depth
         self.label = label
+        self.class_counts = class_counts
+        self.stats = stats
+
+
+# hashmap from label -> count, for the class counts stored on each node
+# inputs:
+#    - classes: label of each class id
+#    - counts: count of each class id
+def count_map(classes, counts):
+    return {int(classes[k]): int(counts[k]) for k in np.flatnonzero(counts)}
+
+
+# majority label of a hashmap from label -> count, ties go to the smallest label
+def majority_label(class_counts):
+    return max(sorted(class_counts), key=class_counts.get)
+
+
+# describes the layout of a dataset, so nothing depends on the 7 access points and 4 rooms of wifi_db
+# each schema stores:
+#   1. n_features: number of feature columns, the label is the last column
+#   2. classes: the sorted distinct labels
+#   3. n_classes: number of distinct labels
+class DatasetSchema:
+    def __init__(self, dataset):
+        self.n_features = dataset.shape[1] - 1
+        self.classes = np.unique(dataset[:, -1].astype(int))
+        self.n_classes = len(self.classes)
+
+    # maps labels to dense class ids 0..n_classes-1, used to index count arrays
+    def encode(self, labels):
+        return np.searchsorted(self.classes, np.asarray(labels).astype(int))
+
+
+# boundaries of k near-equal consecutive folds of n rows, fold i is rows bounds[i]:bounds[i+1]
+def fold_bounds(n_rows, n_folds):
+    return np.arange(n_folds + 1) * n_rows // n_folds
+
+
+# random order of the rows for k-fold cross validation, fold i is order[bounds[i]:bounds[i+1]]
+# with bounds = fold_bounds(n_rows, n_folds), so folds are index arrays and the dataset is never shuffled
+# with labels the folds are stratified: the shuffled rows of each class are dealt out to the folds in turn,
+# so every fold holds close to the same share of each class
+# input:
+#   - n_rows: number of rows of the dataset
+#   - n_folds: number of folds
+#   - seed: seed or np.random.Generator, the same seed gives the same folds
+#   - labels: label of each row, to stratify the folds
+# returns the order of the row indices
+def fold_order(n_rows, n_folds=10, seed=None, labels=None):
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(n_rows)
+    if labels is None:
+        return order
+
+    # group the shuffled rows by class and deal them out, the folds fold_bounds makes larger are dealt first
+    order = order[np.argsort(np.asarray(labels)[order], kind='stable')]
+    folds = np.argsort(-np.diff(fold_bounds(n_rows, n_folds)), kind='stable')[np.arange(n_rows) % n_folds]
+    return order[np.argsort(folds, kind='stable')]
+
+
+# read-only view of a dataset, so the folds of cross validation can share it but never change it
+def read_only(dataset):
+    dataset = np.asarray(dataset).view()
+    dataset.flags.writeable = False
+    return dataset
+
+
+# opt-in instrumentation of training, prediction and pruning
+# nothing is collected unless a Profiler is active (see profiled_fold and the profile argument of tenfold
+# and prune), every instrumented spot checks `profiler is not None` first, so disabled runs only pay for that check
+# each profiler stores:
+#   1. counts: hashmap from counter -> count
+#      nodes_built, candidate_splits (scored), rows_routed (through decision nodes),
+#      prune_attempts and prune_accepted
+#   2. seconds: hashmap from stage -> total wall clock seconds
+#      copy (fold datasets), train, sort, entropy, prune and evaluate (accuracy and confusion matrix)
+#   3. calls: hashmap from stage -> number of times it was timed
+class Profiler:
+    def __init__(self):
+        self.counts = {}
+        self.seconds = {}
+        self.calls = {}
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + int(n)
+
+    def add_time(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    # times the enclosed block as a stage
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    # adds the counters and timers of a report from another profiler
+    def merge(self, report):
+        for name, n in report["counts"].items():
+            self.count(name, n)
+        for name, seconds in report["seconds"].items():
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + report["calls"][name]
+
+    # plain dict of the counters and timers, ready to be dumped as JSON
+    def report(self):
+        return {"counts": dict(self.counts), "seconds": dict(self.seconds), "calls": dict(self.calls)}
+
+
+# the active profiler of this process, None when instrumentation is disabled
+profiler = None
+NO_PROFILE = contextlib.nullcontext()
+
+# times the enclosed block as a stage of the active profiler, does nothing when disabled
+# only used around coarse stages (once per fold), hot loops check `profiler is not None` directly
+def profile_stage(name):
+    if profiler is None:
+        return NO_PROFILE
+    return profiler.stage(name)
+
+# runs a fold function with a fresh profiler active, in this process or a worker of run_folds
+# returns the result of the fold function and the report of its profiler
+def profiled_fold(fold_function, dataset, *fold):
+    global profiler
+    outer = profiler
+    profiler = Profiler()
+    try:
+        result = fold_function(dataset, *fold)
+        return result, profiler.report()
+    finally:
+        profiler = outer
 
 
 
@@ -65,76 +348,234 @@ def computeEntropy(left, dataset_map, count_left, total_count):
     return w * hleft + (1 - w) * hright
 
 
-# recursive decsion tree learning algorithm using information gain
+# computes the entropy of every candidate split of a sorted feature column at once
+# the class terms are added in the given orders, the same order computeEntropy walks its hashmaps,
+# so every entropy is bit for bit the value computeEntropy returns
 # inputs:
-#    - dataset: initially the main dataset, then recurses through subsets
-#    - depth: current depth of the tree
-# returns a decision tree classifier
-def decision_tree_learning(dataset, depth):
+#    - left_counts: (candidates x classes) array, count of each label left of the split
+#    - count_left: number of elements in the left split for each candidate
+#    - class_counts: count of each label in the current split
+#    - total_count: number of elements in the entire dataset for the current split
+#    - left_order: order the classes are added for the left split
+#    - right_order: order the classes are added for the right split
+# returns an array with the entropy of each candidate split
+def compute_split_entropies(left_counts, count_left, class_counts, total_count, left_order, right_order):
+    right_counts = class_counts - left_counts
+    count_right = total_count - count_left
 
-    # map from label -> its count in the current_split
-    dataset_map = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # entropy of left splits, empty classes contribute nothing
+        p = left_counts / count_left[:, None]
+        terms = np.where(left_counts > 0, p * np.log2(p), 0)
+        hleft = -np.cumsum(terms[:, left_order], axis=1)[:, -1]
 
-    # total number of elements in the dataset
-    total_count = len(dataset)
+        # entropy of right splits, the last candidate has an empty right split
+        p = right_counts / count_right[:, None]
+        terms = np.where(right_counts > 0, p * np.log2(p), 0)
+        hright = -np.cumsum(terms[:, right_order], axis=1)[:, -1]
 
-    # get the class labels from the dataset
-    for i in dataset:
-        dataset_map[int(i[-1])] = dataset_map.get(int(i[-1]), 0) + 1
+    # return the total entropy
+    w = count_left / total_count
+    return w * hleft + (1 - w) * hright
 
-    # if there is only one item in the decision tree, then create a leaf/label node
-    if len(dataset_map) == 1:
-        return Node(None, None,  depth = depth, label = next(iter(dataset_map)))
 
+# split criteria of the canonical order builders (presorted, iterative and histogram)
+# the weighted impurity of a split is a sum of per-class terms f(count) looked up in a table indexed by the
+# integer counts, combined with the size of each side, so scoring every candidate of a node is a gather and a sum:
+#   entropy: n * H = n*log2(n) - sum c*log2(c)
+#   gini:    n * G = n - (sum c*c) / n
+# decision_tree_learning keeps compute_split_entropies, which adds the classes in the order of the original code
+# so its trees match the original exactly
+# a new criterion subclasses SplitCriterion and implements term, combine and max_impurity
+class SplitCriterion(abc.ABC):
+    # counts up to this size are looked up, larger counts (only near the root of huge datasets) are computed
+    table_size = 1 << 16
 
-    # entropy the minimum split gives us
-    minEntropy = float("inf")
+    def __init__(self):
+        self.table = self.term(np.arange(self.table_size, dtype=np.float64))
 
-    # splitting feature
-    minEntropy_feature = 0
+    # per-class term f(c) of the criterion, for an array of counts
+    @abc.abstractmethod
+    def term(self, counts):
+        pass
 
-    # split value
-    minEntropySplit = 0
+    # n * impurity of a split from its size and the sum of its class terms
+    @abc.abstractmethod
+    def combine(self, term_sums, count):
+        pass
+
+    def terms(self, counts):
+        if counts.size and counts.max() >= self.table_size:
+            return self.term(counts.astype(np.float64))
+        return self.table[counts]
+
+    # weighted impurity of every candidate split
+    # inputs:
+    #    - left_counts: (candidates x classes) array, count of each class left of the split
+    #    - count_left: number of elements in the left split for each candidate
+    #    - class_counts: count of each class in the current split
+    #    - total_count: number of elements in the current split
+    # returns an array with the impurity of each candidate split
+    def split_impurities(self, left_counts, count_left, class_counts, total_count):
+        left = self.combine(self.terms(left_counts).sum(axis=1), count_left)
+        right = self.combine(self.terms(class_counts - left_counts).sum(axis=1), total_count - count_left)
+        return (left + right) / total_count
+
+    # impurity of a single split from its class counts
+    def impurity(self, class_counts):
+        total_count = class_counts.sum()
+        return self.combine(self.terms(class_counts).sum(), total_count) / total_count
 
-    # index that allows us to split the dataset
+    # largest possible impurity with n_classes classes
+    @abc.abstractmethod
+    def max_impurity(self, n_classes):
+        pass
+
+
+class EntropyCriterion(SplitCriterion):
+    def term(self, counts):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(counts > 0, counts * np.log2(counts), 0.0)
+
+    def combine(self, term_sums, count):
+        return self.terms(count) - term_sums
+
+    def max_impurity(self, n_classes):
+        return np.log2(max(n_classes, 2))
+
+
+class GiniCriterion(SplitCriterion):
+    def term(self, counts):
+        return counts * counts
+
+    def max_impurity(self, n_classes):
+        return 1 - 1 / max(n_classes, 2)
+
+    def combine(self, term_sums, count):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(count > 0, count - term_sums / np.maximum(count, 1), 0.0)
+
+
+# criteria the builders accept by name
+CRITERIA = {"entropy": EntropyCriterion(), "gini": GiniCriterion()}
+
+
+# looks up a criterion by name, SplitCriterion instances are returned as they are
+def get_criterion(criterion):
+    if isinstance(criterion, SplitCriterion):
+        return criterion
+    if criterion not in CRITERIA:
+        raise ValueError(f"criterion must be one of {sorted(CRITERIA)}, not {criterion!r}")
+    return CRITERIA[criterion]
+
+
+# scores every candidate split of one feature
+# per-run class histograms give the class counts left of every candidate threshold, so the
+# count arrays are (candidates x classes) however many rows the split has
+# inputs:
+#    - values: feature values of the current split in sorted order
+#    - sorted_labels: dense class id of each row in the same order
+#    - class_counts: count of each class id in the current split
+#    - class_order: order the classes first appear in the current split
+#    - criterion: SplitCriterion to score with, None for entropy summed in the order of decision_tree_learning
+# returns the index of the last row left of each candidate, and the entropy of each candidate
+def score_feature_splits(values, sorted_labels, class_counts, class_order, criterion=None):
+    n_classes = len(class_counts)
+
+    # candidate splits sit at the last row of each run of equal values
+    new_run = values[1:] != values[:-1]
+    ends = np.flatnonzero(np.append(new_run, True))
+    run_ids = np.concatenate(([0], np.cumsum(new_run)))
+    run_counts = np.bincount(run_ids * n_classes + sorted_labels, minlength=len(ends) * n_classes)
+    left_counts = np.cumsum(run_counts.reshape(len(ends), n_classes), axis=0)
+
+    if criterion is not None:
+        entropies = criterion.split_impurities(left_counts, ends + 1, class_counts, len(values))
+    else:
+        # classes enter the left hashmap in the order of their first row
+        present, first_rows = np.unique(sorted_labels, return_index=True)
+        left_order = present[np.argsort(first_rows)]
+        entropies = compute_split_entropies(left_counts, ends + 1, class_counts, len(values), left_order, class_order)
+    if profiler is not None:
+        profiler.count("candidate_splits", len(ends))
+    return ends, entropies
+
+
+# finds the split with the minimum entropy over all features
+# inputs:
+#    - dataset: current split, label in the last column
+#    - labels: dense class id of each row of the dataset
+#    - class_order: order the classes first appear in the dataset
+# returns the splitting feature, split value, split index and the dataset as sorted by the last feature
+def find_best_split(dataset, labels, class_order):
+
+    class_counts = np.bincount(labels, minlength=len(class_order))
+
+    minEntropy = float("inf")
+    minEntropy_feature = 0
+    minEntropySplit = 0
     minEntropyidx = 0
 
-    # loop over each feature, and then find a value to to split on that gives us the minimum entropy
-    for feature in range(7):
+    for feature in range(dataset.shape[1] - 1):
+        if profiler is not None:
+            start = time.perf_counter()
 
         # sort the dataset with respect to the current feature
-        dataset = dataset[np.apply_along_axis(lambda x: x[feature], 1, dataset).argsort()]
-        left = {}
-        idx = 0
-        val = dataset[idx][feature]
+        order = dataset[:, feature].argsort()
+        dataset = dataset[order]
+        labels = labels[order]
+        values = dataset[:, feature]
+
+        if profiler is not None:
+            sorted_time = time.perf_counter()
+            profiler.add_time("sort", sorted_time - start)
 
-        # loop over splits, find the one with the minimum entropy
-        # loop over dataset
-        while idx < len(dataset):
+        ends, entropies = score_feature_splits(values, labels, class_counts, class_order)
+        if profiler is not None:
+            profiler.add_time("entropy", time.perf_counter() - sorted_time)
 
-            # frequency count for left split
-            while idx < len(dataset) and dataset[idx][feature] == val:
-                left[dataset[idx][-1]] = left.get(dataset[idx][-1], 0) + 1
-                idx += 1
+        # first minimum wins, same as scanning the thresholds in increasing order
+        best = np.argmin(entropies)
+        if entropies[best] < minEntropy:
+            minEntropy = entropies[best]
+            minEntropy_feature = feature
+            minEntropySplit = values[ends[best]]
+            minEntropyidx = ends[best] + 1
 
-            # get entropy of our left split
-            entropy = computeEntropy(left, dataset_map, idx, total_count)
+    return minEntropy_feature, minEntropySplit, minEntropyidx, dataset
 
-            # if entropy of split is less than the current minimum entropy, use this new split instead
-            if  entropy < minEntropy:
-                minEntropy = entropy
-                minEntropy_feature = feature
-                minEntropySplit = val
-                minEntropyidx = idx
-            if idx < len(dataset):
-                val = dataset[idx][feature]
 
+# recursive decsion tree learning algorithm using information gain
+# inputs:
+#    - dataset: initially the main dataset, then recurses through subsets
+#    - depth: current depth of the tree
+# returns a decision tree classifier
+def decision_tree_learning(dataset, depth):
+    if profiler is not None:
+        profiler.count("nodes_built")
+
+    # get the class labels from the dataset as dense ids, in order of first appearance
+    classes, first_rows, labels = np.unique(dataset[:, -1].astype(int), return_index=True, return_inverse=True)
+    class_order = np.argsort(first_rows)
+
+    class_counts = count_map(classes, np.bincount(labels))
+
+    # if there is only one item in the decision tree, then create a leaf/label node
+    if len(classes) == 1:
+        return Node(None, None,  depth = depth, label = int(classes[0]), class_counts = class_counts)
+
+    # loop over each feature, and then find a value to to split on that gives us the minimum entropy
+    minEntropy_feature, minEntropySplit, minEntropyidx, dataset = find_best_split(dataset, labels, class_order)
+
+    # identical feature values with different labels cannot be split, label with the majority class
+    if minEntropyidx == len(dataset):
+        return Node(None, None, depth = depth, label = majority_label(class_counts), class_counts = class_counts)
 
     # sort the dataset with respect to the feature that minimises the entropy
-    dataset = dataset[np.apply_along_axis(lambda x: x[minEntropy_feature], 1, dataset).argsort()]
+    dataset = dataset[dataset[:, minEntropy_feature].argsort()]
 
     # create a left and right node, based on splitting feature.
-    ret = Node(minEntropy_feature, minEntropySplit, depth = depth, left = None, right = None, label=None)
+    ret = Node(minEntropy_feature, minEntropySplit, depth = depth, left = None, right = None, label=None, class_counts = class_counts)
 
     # recurse through child subsets (left and right) created to continue learning
     leftTree = decision_tree_learning(dataset[:minEntropyidx], depth + 1)
@@ -149,7 +590,851 @@ def decision_tree_learning(dataset, depth):
 
 
 
+# decision tree learning that sorts every feature column once at the root (SLIQ/SPRINT style)
+# the sorted index arrays are then stably partitioned down the tree, so no node sorts or copies the dataset
+# with the entropy criterion it builds the same tree as decision_tree_learning, except where two candidate
+# splits have mathematically equal entropy and floating point rounding decides between them
+# inputs:
+#    - dataset: the main dataset
+#    - depth: depth of the root node
+#    - criterion: "entropy", "gini" or a SplitCriterion
+# returns a decision tree classifier
+def decision_tree_learning_presorted(dataset, depth=0, criterion="entropy"):
+    classes, labels = encode_labels(dataset)
+
+    # (features x rows) array, row indices sorted on each feature
+    sorted_idx = np.argsort(dataset[:, :-1], axis=0, kind='stable').T
+
+    # scratch mask shared by every node, marks rows that go to the left child
+    goes_left = np.zeros(len(dataset), dtype=bool)
+    return build_presorted_node(dataset, classes, labels, sorted_idx, goes_left, depth,
+                                criterion=get_criterion(criterion))
+
+
+# encodes the labels of a dataset as dense class ids 0..K-1
+# input:
+#    - dataset: label in the last column
+# returns the sorted distinct labels and the class id of each row
+def encode_labels(dataset):
+    return np.unique(dataset[:, -1].astype(int), return_inverse=True)
+
+
+# recursive step of decision_tree_learning_presorted
+# inputs:
+#    - dataset: the main dataset, never copied
+#    - classes: sorted distinct labels of the main dataset
+#    - labels: dense class id of each row of the main dataset
+#    - sorted_idx: (features x split size) array, row indices of the current split sorted on each feature
+#    - goes_left: boolean scratch mask over all rows, all False on entry and exit
+#    - depth: current depth of the tree
+#    - class_counts: count of each label in the current split, computed here if not given
+#    - criterion: SplitCriterion to choose splits with
+# returns the decision tree for the current split
+def build_presorted_node(dataset, classes, labels, sorted_idx, goes_left, depth, class_counts=None,
+                         criterion=CRITERIA["entropy"]):
+    if profiler is not None:
+        profiler.count("nodes_built")
+
+    # if there is only one label in the current split, then create a leaf/label node
+    if class_counts is None:
+        class_counts = np.bincount(labels[sorted_idx[0]], minlength=len(classes))
+    if np.count_nonzero(class_counts) == 1:
+        return Node(None, None, depth = depth, label = int(classes[np.argmax(class_counts)]), class_counts = count_map(classes, class_counts))
+
+    _, feature, split_val, idx = find_best_presorted_split(dataset, labels, sorted_idx, class_counts, criterion=criterion)
+
+    # identical feature values with different labels cannot be split, label with the majority class
+    if idx == sorted_idx.shape[1]:
+        return Node(None, None, depth = depth, label = int(classes[np.argmax(class_counts)]), class_counts = count_map(classes, class_counts))
+
+    left_idx, right_idx = partition_sorted_indices(sorted_idx, feature, idx, goes_left)
+
+    ret = Node(feature, split_val, depth = depth, left = None, right = None, label=None,
+               class_counts = count_map(classes, class_counts))
+    ret.left = build_presorted_node(dataset, classes, labels, left_idx, goes_left, depth + 1, criterion=criterion)
+    ret.right = build_presorted_node(dataset, classes, labels, right_idx, goes_left, depth + 1, criterion=criterion)
+    return ret
+
+
+# finds the split with the minimum entropy over all features from presorted row indices
+# inputs:
+#    - dataset: the main dataset
+#    - labels: dense class id of each row of the main dataset
+#    - sorted_idx: (features x split size) array, row indices of the current split sorted on each feature
+#    - class_counts: count of each class id in the current split
+#    - features: increasing subset of features to consider, None for every feature
+#    - criterion: SplitCriterion to score the splits with
+# returns the minimum impurity, splitting feature, split value and the number of rows in the left split
+def find_best_presorted_split(dataset, labels, sorted_idx, class_counts, features=None, criterion=CRITERIA["entropy"]):
+    minEntropy = float("inf")
+    minEntropy_feature = 0
+    minEntropySplit = 0
+    minEntropyidx = 0
+    class_order = np.arange(len(class_counts))
+
+    if profiler is not None:
+        start = time.perf_counter()
+
+    for feature in (range(len(sorted_idx)) if features is None else features):
+        order = sorted_idx[feature]
+        values = dataset[order, feature]
+        ends, entropies = score_feature_splits(values, labels[order], class_counts, class_order, criterion)
+
+        best = np.argmin(entropies)
+        if entropies[best] < minEntropy:
+            minEntropy = entropies[best]
+            minEntropy_feature = feature
+            minEntropySplit = values[ends[best]]
+            minEntropyidx = ends[best] + 1
+
+    if profiler is not None:
+        profiler.add_time("entropy", time.perf_counter() - start)
+    return minEntropy, minEntropy_feature, minEntropySplit, minEntropyidx
+
+
+# stable partition of every sorted index array of a split, keeps each child sorted on every feature
+# inputs:
+#    - sorted_idx: (features x split size) array, row indices of the current split sorted on each feature
+#    - feature: splitting feature
+#    - idx: number of rows in the left split
+#    - goes_left: boolean scratch mask over all rows, all False on entry and exit
+# returns the sorted index arrays of the left and right child
+def partition_sorted_indices(sorted_idx, feature, idx, goes_left):
+    goes_left[sorted_idx[feature, :idx]] = True
+    keep = goes_left[sorted_idx]
+    left_idx = sorted_idx[keep].reshape(len(sorted_idx), idx)
+    right_idx = sorted_idx[~keep].reshape(len(sorted_idx), -1)
+    goes_left[left_idx[0]] = False
+    return left_idx, right_idx
+
+
+# iterative decision tree learning with an explicit work queue instead of recursion, so tree depth
+# is not bounded by the Python recursion limit
+# every node works on presorted index arrays of its rows, and the nodes waiting in the queue always
+# hold disjoint rows, so the queue never holds more than one (rows x features) index array in total
+# nodes are expanded depth first (same order and, without limits, same tree as decision_tree_learning_presorted)
+# or best first (largest reduction in impurity first), and stop early on the limits below
+# inputs:
+#    - dataset: the main dataset
+#    - max_depth: nodes at this depth become leaves, None for no limit
+#    - min_samples_split: nodes with fewer training examples become leaves
+#    - max_leaves: stop splitting once the tree has this many leaves, None for no limit
+#    - order: "depth" or "best"
+#    - max_features: number of features drawn at random for each node to choose its split from
+#      (random forest style), None to always consider every feature
+#    - seed: seed or np.random.Generator used to draw the features
+#    - criterion: "entropy", "gini" or a SplitCriterion
+# returns a decision tree classifier
+def decision_tree_learning_iterative(dataset, max_depth=None, min_samples_split=2, max_leaves=None, order="depth",
+                                     max_features=None, seed=None, criterion="entropy"):
+    if order not in ("depth", "best"):
+        raise ValueError(f"order must be 'depth' or 'best', not {order!r}")
+    criterion = get_criterion(criterion)
+    n_features = dataset.shape[1] - 1
+    if max_features is not None and max_features >= n_features:
+        max_features = None
+    rng = np.random.default_rng(seed)
+
+    classes, labels = encode_labels(dataset)
+    sorted_idx = np.argsort(dataset[:, :-1], axis=0, kind='stable').T
+    goes_left = np.zeros(len(dataset), dtype=bool)
+
+    # each queued item is a leaf that may still be split:
+    # (priority, insertion number, node, sorted indices, class counts, split)
+    queue = []
+    inserted = 0
+
+    # creates a node as a leaf and queues it if it can be split
+    def add_leaf(node_idx, class_counts, depth):
+        nonlocal inserted
+        if profiler is not None:
+            profiler.count("nodes_built")
+        node = Node(None, None, depth = depth, label = int(classes[np.argmax(class_counts)]),
+                    class_counts = count_map(classes, class_counts))
+        n_rows = node_idx.shape[1]
+        if np.count_nonzero(class_counts) == 1 or n_rows < min_samples_split:
+            return node
+        if max_depth is not None and depth >= max_depth:
+            return node
+
+        if max_features is None:
+            split = find_best_presorted_split(dataset, labels, node_idx, class_counts, criterion=criterion)
+        else:
+            features = np.sort(rng.choice(n_features, max_features, replace=False))
+            split = find_best_presorted_split(dataset, labels, node_idx, class_counts, features, criterion)
+
+            # the drawn features may all be constant in this node, fall back to every feature
+            if split[3] == n_rows:
+                split = find_best_presorted_split(dataset, labels, node_idx, class_counts, criterion=criterion)
+
+        # identical feature values with different labels cannot be split
+        if split[3] == n_rows:
+            return node
+
+        # best first pops the largest total entropy reduction, depth first pops the newest node
+        if order == "best":
+            priority = -(criterion.impurity(class_counts) - split[0]) * n_rows
+            heapq.heappush(queue, (priority, inserted, node, node_idx, class_counts, split))
+        else:
+            queue.append((0, inserted, node, node_idx, class_counts, split))
+        inserted += 1
+        return node
+
+    root = add_leaf(sorted_idx, np.bincount(labels, minlength=len(classes)), 0)
+    del sorted_idx
+    leaves = 1
+
+    while queue and (max_leaves is None or leaves < max_leaves):
+        _, _, node, node_idx, class_counts, split = heapq.heappop(queue) if order == "best" else queue.pop()
+        _, feature, split_val, idx = split
+
+        # turn the leaf into a decision node
+        left_idx, right_idx = partition_sorted_indices(node_idx, feature, idx, goes_left)
+        del node_idx
+        left_counts = np.bincount(labels[left_idx[0]], minlength=len(classes))
+        node.feature, node.split_val, node.label = feature, split_val, None
+        leaves += 1
+
+        # queue the right child first, so depth first order expands the left child next
+        node.right = add_leaf(right_idx, class_counts - left_counts, node.depth + 1)
+        node.left = add_leaf(left_idx, left_counts, node.depth + 1)
+
+    return root
+
+
+
+
+
+
+
+
+
+
+# quantizes every feature of a dataset into at most max_bins bins, once for the whole tree
+# features with few distinct values (e.g. integer RSSI in dBm) get one bin per value, others get quantile bins
+# inputs:
+#    - dataset: label in the last column
+#    - max_bins: at most 256, so bin codes fit in uint8
+# returns (rows x features) uint8 bin codes, and for each feature the largest value in each bin
+def bin_dataset(dataset, max_bins=256):
+    check_max_bins(max_bins)
+    bin_values = []
+    for feature in range(dataset.shape[1] - 1):
+        column = dataset[:, feature]
+        edges = np.unique(column)
+        if len(edges) > max_bins:
+            edges = np.unique(np.quantile(column, np.linspace(0, 1, max_bins + 1)[1:], method='lower'))
+        bin_values.append(edges)
+    return bin_codes(dataset, bin_values), bin_values
+
+
+# bin codes are stored as uint8, so no feature can have more bins than this
+MAX_BINS = 256
+
+# raises ValueError for a number of bins whose codes would not fit in uint8
+def check_max_bins(max_bins):
+    if not 1 <= max_bins <= MAX_BINS:
+        raise ValueError(f"max_bins must be between 1 and {MAX_BINS}, not {max_bins}")
+
+
+# integer bin edges spanning at most this many values are binned with a lookup table
+BIN_TABLE_SIZE = 1 << 16
+
+# bin codes of every feature of a dataset from the bin edges found by bin_dataset
+# bin b holds the values above edges[b-1] up to and including edges[b]
+# returns (rows x features) uint8 bin codes
+def bin_codes(dataset, bin_values):
+    if any(len(edges) > MAX_BINS for edges in bin_values):
+        raise ValueError(f"bin codes are uint8, a feature cannot have more than {MAX_BINS} bins")
+    codes = np.empty((len(dataset), len(bin_values)), dtype=np.uint8)
+    for feature, edges in enumerate(bin_values):
+        column = dataset[:, feature]
+        low, high = edges[0], edges[-1]
+
+        # integer edges over a small range (e.g. RSSI in dBm) index a table of codes by the rounded up value,
+        # which is much faster than a binary search per value
+        if high - low <= BIN_TABLE_SIZE and np.all(edges == np.round(edges)):
+            table = np.searchsorted(edges, np.arange(low, high + 2), side='left')
+            feature_codes = table[(np.clip(np.ceil(column), low, high + 1) - low).astype(np.intp)]
+        else:
+            feature_codes = np.searchsorted(edges, column, side='left')
+
+        # values above the last edge fall in the last bin, clamped before the cast so 256 bins cannot wrap to 0
+        codes[:, feature] = np.minimum(feature_codes, len(edges) - 1)
+    return codes
+
+
+# layout of a histogram over the bins of all features, each feature only gets as many bins as it has bin values
+# input:
+#    - bin_values: for each feature, the largest value in each bin
+# returns the first bin of each feature, and the feature of each bin
+def bin_offsets(bin_values):
+    sizes = np.array([len(values) for values in bin_values], dtype=np.intp)
+    return np.concatenate(([0], np.cumsum(sizes)[:-1])), np.repeat(np.arange(len(sizes)), sizes)
+
+
+# per-node class histogram over the bin codes of every feature
+# inputs:
+#    - codes: (rows x features) bin codes of the main dataset
+#    - labels: dense class id of each row
+#    - rows: rows of the current split
+#    - offsets: first bin of each feature, see bin_offsets
+#    - n_bins: total number of bins
+#    - n_classes: number of classes
+# returns a (bins x classes) count array, the bins of feature f start at offsets[f]
+def class_histogram(codes, labels, rows, offsets, n_bins, n_classes):
+    idx = ((offsets[None, :] + codes[rows]) * n_classes + labels[rows][:, None]).ravel()
+    return np.bincount(idx, minlength=n_bins * n_classes).reshape(n_bins, n_classes)
+
+
+# histograms with at most this many cells are always cheaper than scoring a node from its rows
+HISTOGRAM_MIN_CELLS = 1 << 16
+
+# whether a node of the histogram builder is scored from a class histogram rather than from its rows
+# a histogram costs (bins x classes) whatever the number of rows, so with many features and classes
+# small nodes are cheaper to score directly
+def uses_histogram(n_rows, n_features, n_bins, n_classes):
+    return n_bins * n_classes <= max(n_rows * n_features, HISTOGRAM_MIN_CELLS)
+
+
+# best split of a node from its class histogram, every non-empty bin is a candidate
+# inputs:
+#    - histogram: (bins x classes) class histogram of the node
+#    - offsets, bin_features: layout of the histogram, see bin_offsets
+#    - class_counts: count of each class in the node
+#    - n_rows: number of rows of the node
+#    - criterion: SplitCriterion to choose the split with
+# returns the feature and bin of the split
+def best_histogram_split(histogram, offsets, bin_features, class_counts, n_rows, criterion):
+    # every row falls in one bin of each feature, so the running total over all bins
+    # has counted the class counts once per earlier feature
+    left_counts = np.cumsum(histogram, axis=0) - bin_features[:, None] * class_counts[None, :]
+    candidates = np.flatnonzero(histogram.sum(axis=1))
+    impurities = criterion.split_impurities(left_counts[candidates], left_counts[candidates].sum(axis=1),
+                                            class_counts, n_rows)
+    if profiler is not None:
+        profiler.count("candidate_splits", len(candidates))
+
+    # first minimum wins, same as scanning features and thresholds in increasing order
+    best = candidates[np.argmin(impurities)]
+    feature = int(bin_features[best])
+    return feature, best - offsets[feature]
+
+
+# best split of a node from the bin codes of its rows, with the same candidates and scores as best_histogram_split
+# returns the feature and bin of the split
+def best_row_split(codes, labels, rows, class_counts, criterion):
+    best_impurity, best_feature, best_bin = np.inf, 0, 0
+    node_labels = labels[rows]
+    for feature in range(codes.shape[1]):
+        column = codes[rows, feature]
+        order = np.argsort(column, kind='stable')
+        values = column[order]
+        ends, impurities = score_feature_splits(values, node_labels[order], class_counts, None, criterion)
+        best = np.argmin(impurities)
+        if impurities[best] < best_impurity:
+            best_impurity, best_feature, best_bin = impurities[best], feature, int(values[ends[best]])
+    return best_feature, best_bin
+
+
+# decision tree learning on histogram-binned features (LightGBM style)
+# features are quantized to uint8 bin codes once, and splits are found by scanning per-node class histograms
+# only the smaller child of every split gets a histogram, the larger one is its parent minus its sibling
+# nodes with fewer rows than their histogram has cells are scored from their rows instead, see uses_histogram
+# with at most max_bins distinct values per feature the candidate splits are the same as decision_tree_learning
+# inputs:
+#    - dataset: the main dataset
+#    - depth: depth of the root node
+#    - max_bins: maximum number of bins per feature, at most 256
+#    - criterion: "entropy", "gini" or a SplitCriterion
+# returns a decision tree classifier
+def decision_tree_learning_histogram(dataset, depth=0, max_bins=256, criterion="entropy"):
+    codes, bin_values = bin_dataset(dataset, max_bins)
+    classes, labels = encode_labels(dataset)
+    offsets, bin_features = bin_offsets(bin_values)
+
+    rows = np.arange(len(dataset))
+    histogram = None
+    if uses_histogram(len(rows), len(bin_values), len(bin_features), len(classes)):
+        histogram = class_histogram(codes, labels, rows, offsets, len(bin_features), len(classes))
+    return build_histogram_node(codes, labels, classes, bin_values, rows, histogram, depth, get_criterion(criterion),
+                                (offsets, bin_features))
+
+
+# recursive step of decision_tree_learning_histogram
+# the histogram of the node is reused for its larger child by subtracting the smaller child in place, and
+# the smaller child is built first, so only one histogram per smaller child on the path from the root
+# (at most log2(rows) of them) is alive at a time
+# inputs:
+#    - codes: (rows x features) bin codes of the main dataset
+#    - labels: dense class id of each row
+#    - classes: label of each class id
+#    - bin_values: for each feature, the largest value in each bin
+#    - rows: rows of the current split
+#    - histogram: (bins x classes) class histogram of the current split, changed in place,
+#      or None to score the split from its rows
+#    - depth: current depth of the tree
+#    - criterion: SplitCriterion to choose splits with
+#    - layout: bin_offsets of bin_values, computed if not given
+# returns the decision tree for the current split
+def build_histogram_node(codes, labels, classes, bin_values, rows, histogram, depth, criterion=CRITERIA["entropy"],
+                         layout=None):
+    if profiler is not None:
+        profiler.count("nodes_built")
+
+    # if there is only one label in the current split, then create a leaf/label node
+    if histogram is None:
+        class_counts = np.bincount(labels[rows], minlength=len(classes))
+    else:
+        class_counts = histogram[:len(bin_values[0])].sum(axis=0)
+    if np.count_nonzero(class_counts) == 1:
+        return Node(None, None, depth = depth, label = int(classes[np.argmax(class_counts)]), class_counts = count_map(classes, class_counts))
+
+    if layout is None:
+        layout = bin_offsets(bin_values)
+    offsets, bin_features = layout
+    n_bins = len(bin_features)
+    if profiler is not None:
+        start = time.perf_counter()
+    if histogram is None:
+        feature, split_bin = best_row_split(codes, labels, rows, class_counts, criterion)
+    else:
+        feature, split_bin = best_histogram_split(histogram, offsets, bin_features, class_counts, len(rows), criterion)
+    if profiler is not None:
+        profiler.add_time("entropy", time.perf_counter() - start)
+
+    # identical feature values with different labels cannot be split, label with the majority class
+    goes_left = codes[rows, feature] <= split_bin
+    if goes_left.all():
+        return Node(None, None, depth = depth, label = int(classes[np.argmax(class_counts)]), class_counts = count_map(classes, class_counts))
+
+    ret = Node(int(feature), bin_values[feature][split_bin], depth = depth, left = None, right = None, label=None,
+               class_counts = count_map(classes, class_counts))
+    left_rows, right_rows = rows[goes_left], rows[~goes_left]
+    small_rows, large_rows = (left_rows, right_rows) if len(left_rows) <= len(right_rows) else (right_rows, left_rows)
+    del rows, goes_left
+
+    # the larger child gets this histogram minus the smaller child's, changed in place
+    n_classes = len(classes)
+    small_histogram = None
+    if histogram is not None:
+        small_histogram = class_histogram(codes, labels, small_rows, offsets, n_bins, n_classes)
+        if uses_histogram(len(large_rows), len(offsets), n_bins, n_classes):
+            histogram -= small_histogram
+        else:
+            histogram = None
+        if not uses_histogram(len(small_rows), len(offsets), n_bins, n_classes):
+            small_histogram = None
+
+    # the smaller child is built first, so a node only holds the histogram of its larger child while
+    # building a child with at most half its rows
+    small_tree = build_histogram_node(codes, labels, classes, bin_values, small_rows, small_histogram, depth + 1,
+                                      criterion, layout)
+    del small_histogram
+    large_tree = build_histogram_node(codes, labels, classes, bin_values, large_rows, histogram, depth + 1, criterion,
+                                      layout)
+
+    ret.left, ret.right = (small_tree, large_tree) if small_rows is left_rows else (large_tree, small_tree)
+    return ret
+
+
+
+# bytes read at a time by the out-of-core builder
+STREAM_CHUNK_BYTES = 1 << 26
+
+# yields a dataset chunk by chunk
+# input:
+#    - source: array or np.memmap (e.g. from load_dataset), path of a dataset file, or a function returning
+#      a new iterator over (rows x columns) chunks every time it is called
+#    - chunk_bytes: size of each chunk when slicing an array, at least one row
+def dataset_chunks(source, chunk_bytes=STREAM_CHUNK_BYTES):
+    if callable(source):
+        yield from source()
+        return
+    if isinstance(source, (str, os.PathLike)):
+        source = load_dataset(os.fspath(source))
+    chunk_rows = max(1, chunk_bytes // max(source.shape[1] * source.dtype.itemsize, 1))
+    for start in range(0, len(source), chunk_rows):
+        yield np.asarray(source[start:start + chunk_rows])
+
+
+# uniform sample of size rows out of a multiset of values, as the rows with the smallest random keys would be
+# the keys are the smallest size of n_rows uniform keys, drawn as order statistics so they can be merged with
+# the keys of later rows
+# inputs:
+#    - values: distinct values, counts: number of rows holding each value
+#    - size: most rows to keep
+#    - rng: np.random.Generator
+# returns the sampled values and their keys
+def sample_counts(values, counts, size, rng):
+    n_rows = int(counts.sum())
+    if n_rows <= size:
+        return rng.permutation(np.repeat(values, counts)), rng.random(n_rows)
+    sampled = rng.permutation(np.repeat(values, rng.multivariate_hypergeometric(counts, size)))
+    gaps = np.cumsum(rng.exponential(size=size))
+    return sampled, gaps / (gaps[-1] + rng.gamma(n_rows - size + 1))
+
+
+# finds the labels and the bin edges of every feature in one streaming pass, like bin_dataset
+# features with at most max_bins distinct values get one bin per value, counted exactly. A feature that
+# overflows max_bins switches to quantile bins from a uniform sample of its values (the values with the
+# smallest random keys), only those features are sampled and the samples together take at most sample_bytes
+# inputs:
+#    - source, chunk_bytes: see dataset_chunks
+#    - max_bins: at most 256, so bin codes fit in uint8
+#    - sample_bytes: memory the samples of all features may take
+#    - seed: seed of the samples
+# returns the sorted distinct labels, for each feature the largest value in each bin, and the number of rows
+def stream_bins(source, chunk_bytes=STREAM_CHUNK_BYTES, max_bins=256, sample_bytes=1 << 26, seed=0):
+    check_max_bins(max_bins)
+    rng = np.random.default_rng(seed)
+    classes = np.array([], dtype=int)
+    distinct, samples = None, None
+    n_rows = 0
+    for chunk in dataset_chunks(source, chunk_bytes):
+        if len(chunk) == 0:
+            continue
+        features = chunk[:, :-1]
+        n_rows += len(chunk)
+        classes = np.union1d(classes, chunk[:, -1].astype(int))
+        if distinct is None:
+            n_features = features.shape[1]
+            distinct = [(np.array([]), np.array([], dtype=np.int64)) for _ in range(n_features)]
+            samples = [None] * n_features
+            maxima = np.full(n_features, -np.inf)
+
+            # a value and its key take 16 bytes
+            sample_rows = max(max_bins, sample_bytes // (16 * max(n_features, 1)))
+        maxima = np.maximum(maxima, features.max(axis=0))
+
+        for feature in range(n_features):
+            column = features[:, feature]
+
+            # distinct values are counted while they fit in max_bins
+            if samples[feature] is None:
+                values, inverse = np.unique(np.concatenate((distinct[feature][0], column)), return_inverse=True)
+                if len(values) <= max_bins:
+                    weights = np.concatenate((distinct[feature][1], np.ones(len(column), dtype=np.int64)))
+                    distinct[feature] = values, np.bincount(inverse, weights, minlength=len(values)).astype(np.int64)
+                    continue
+
+                # overflowed: the earlier rows become a sample and only this chunk is sampled below
+                samples[feature] = sample_counts(*distinct[feature], sample_rows, rng)
+                distinct[feature] = None
+
+            # keep the values with the smallest random keys, a uniform sample of every row so far
+            sample, keys = samples[feature]
+            sample, keys = np.concatenate((sample, column)), np.concatenate((keys, rng.random(len(column))))
+            if len(sample) > sample_rows:
+                keep = np.argpartition(keys, sample_rows)[:sample_rows]
+                sample, keys = sample[keep], keys[keep]
+            samples[feature] = sample, keys
+
+    bin_values = []
+    for feature in range(len(distinct)):
+        if samples[feature] is None:
+            bin_values.append(distinct[feature][0])
+            continue
+        sample = samples[feature][0]
+        values = np.unique(np.quantile(sample, np.linspace(0, 1, max_bins + 1)[1:], method='lower'))
+
+        # the sample may miss the largest values, the last bin takes them
+        values[-1] = maxima[feature]
+        bin_values.append(values)
+    return classes, bin_values, n_rows
+
+
+# out-of-core decision tree learning for datasets larger than memory
+# the tree is grown level by level from per-node class histograms (as in decision_tree_learning_histogram),
+# accumulated chunk by chunk in one streaming pass over the source per level
+# no per-row state is kept: every chunk is routed down the tree built so far on each pass, and only the rows
+# reaching the nodes being split are binned and counted, so the resident state is one chunk plus the (nodes x features x bins x classes) histograms of the nodes being split,
+# and levels whose histograms would take more than max_histogram_bytes are split over several passes
+# with the same bins and criterion it builds the same tree as decision_tree_learning_histogram
+# inputs:
+#    - source: array or np.memmap, path of a dataset file or a function returning an iterator over chunks,
+#      see dataset_chunks
+#    - max_depth: nodes at this depth become leaves, None for no limit
+#    - min_samples_split: nodes with fewer training examples become leaves
+#    - max_bins: maximum number of bins per feature, at most 256
+#    - criterion: "entropy", "gini" or a SplitCriterion
+#    - chunk_bytes: size of each chunk when slicing an array, see dataset_chunks
+#    - max_histogram_bytes: memory the histograms of one pass may take
+# returns a decision tree classifier
+def decision_tree_learning_streaming(source, max_depth=None, min_samples_split=2, max_bins=256, criterion="entropy",
+                                     chunk_bytes=STREAM_CHUNK_BYTES, max_histogram_bytes=1 << 28):
+    criterion = get_criterion(criterion)
+    classes, bin_values, _ = stream_bins(source, chunk_bytes, max_bins)
+    n_features, n_classes = len(bin_values), len(classes)
+    n_bins = max(len(values) for values in bin_values)
+    nodes_per_pass = max(1, max_histogram_bytes // (n_features * n_bins * n_classes * 8))
+
+    # the tree built so far, as parallel lists indexed by node id
+    # leaves and nodes waiting to be split have feature -1, the nodes of the current pass get a histogram slot
+    nodes, node_feature, node_threshold, node_left, node_right = [], [], [], [], []
+
+    def add_node(depth):
+        nodes.append(Node(None, None, depth = depth))
+        node_feature.append(-1)
+        node_threshold.append(0.0)
+        node_left.append(-1)
+        node_right.append(-1)
+        return len(nodes) - 1
+
+    frontier = [add_node(0)]
+    while frontier:
+        next_frontier = []
+        for start in range(0, len(frontier), nodes_per_pass):
+            batch = frontier[start:start + nodes_per_pass]
+            feature, threshold = np.array(node_feature), np.array(node_threshold)
+            left, right = np.array(node_left), np.array(node_right)
+            slot = np.full(len(nodes), -1)
+            slot[batch] = np.arange(len(batch))
+
+            # one streaming pass: route every row to its node and count it in that node's histogram
+            histograms = np.zeros(len(batch) * n_features * n_bins * n_classes, dtype=np.int64)
+            feature_offsets = np.arange(n_features) * n_bins
+            for chunk in dataset_chunks(source, chunk_bytes):
+                node = np.zeros(len(chunk), dtype=np.intp)
+                active = np.arange(len(chunk))
+                while active.size:
+                    current = node[active]
+                    internal = feature[current] >= 0
+                    active, current = active[internal], current[internal]
+                    go_left = chunk[active, feature[current]] <= threshold[current]
+                    node[active] = np.where(go_left, left[current], right[current])
+
+                # split values are bin edges, so routing on values matches routing on bin codes
+                rows = np.flatnonzero(slot[node] >= 0)
+                if profiler is not None:
+                    profiler.count("rows_routed", len(chunk))
+                codes = bin_codes(chunk[rows], bin_values)
+                labels = np.searchsorted(classes, chunk[rows, -1].astype(int))
+                offsets = (slot[node[rows]] * n_features)[:, None] * n_bins + feature_offsets[None, :] + codes
+                histograms += np.bincount((offsets * n_classes + labels[:, None]).ravel(),
+                                          minlength=len(histograms))
+            histograms = histograms.reshape(len(batch), n_features, n_bins, n_classes)
+
+            for node_id, histogram in zip(batch, histograms):
+                if profiler is not None:
+                    profiler.count("nodes_built")
+                next_frontier += split_streaming_node(nodes, node_id, histogram, classes, bin_values, criterion,
+                                                      max_depth, min_samples_split, node_feature, node_threshold,
+                                                      node_left, node_right, add_node)
+        frontier = next_frontier
+    return nodes[0]
+
+
+# turns one node of decision_tree_learning_streaming into a leaf or a split, from its class histogram
+# inputs:
+#    - nodes: Node of every node id
+#    - node_id: the node
+#    - histogram: (features x bins x classes) class histogram of the rows reaching the node
+#    - classes, bin_values: labels and bin edges found by stream_bins
+#    - criterion, max_depth, min_samples_split: see decision_tree_learning_streaming
+#    - node_feature, node_threshold, node_left, node_right: routing lists of decision_tree_learning_streaming
+#    - add_node: creates a child node at a depth, returns its id
+# returns the ids of the children to split on the next level
+def split_streaming_node(nodes, node_id, histogram, classes, bin_values, criterion, max_depth, min_samples_split,
+                         node_feature, node_threshold, node_left, node_right, add_node):
+    node = nodes[node_id]
+    class_counts = histogram[0].sum(axis=0)
+    node.class_counts = count_map(classes, class_counts)
+    node.label = int(classes[np.argmax(class_counts)])
+    n_rows = class_counts.sum()
+    if np.count_nonzero(class_counts) <= 1 or n_rows < min_samples_split:
+        return []
+    if max_depth is not None and node.depth >= max_depth:
+        return []
+
+    # every non-empty bin is a candidate, scored from the cumulative histogram, same as build_histogram_node
+    n_features, n_bins, n_classes = histogram.shape
+    left_counts = np.cumsum(histogram, axis=1).reshape(-1, n_classes)
+    candidates = np.flatnonzero(histogram.sum(axis=2).ravel())
+    impurities = criterion.split_impurities(left_counts[candidates], left_counts[candidates].sum(axis=1),
+                                            class_counts, n_rows)
+    if profiler is not None:
+        profiler.count("candidate_splits", len(candidates))
+    best = candidates[np.argmin(impurities)]
+    feature, split_bin = divmod(best, n_bins)
+
+    # identical feature values with different labels cannot be split
+    if left_counts[best].sum() == n_rows:
+        return []
+
+    node.feature, node.split_val, node.label = int(feature), bin_values[feature][split_bin], None
+    node_feature[node_id], node_threshold[node_id] = node.feature, node.split_val
+    node_left[node_id], node_right[node_id] = add_node(node.depth + 1), add_node(node.depth + 1)
+    node.left, node.right = nodes[node_left[node_id]], nodes[node_right[node_id]]
+    return [node_left[node_id], node_right[node_id]]
+
+
+
+# incremental decision tree learning (Hoeffding tree style) for labelled scans arriving in batches
+# every leaf keeps sufficient statistics on its Node: class histograms over fixed bins of every feature, counted
+# from the rows that reached it since it became a leaf. A batch is routed down the tree once, added to the
+# statistics of the leaves it reaches, and only those leaves are considered for a split, so an update costs
+# time proportional to the batch, never to the rows seen before
+# the class counts of every node the batch passes are updated too, so they always count every row seen and
+# prune_node and cost_complexity_path work on the tree as on a batch-built one
+# a leaf holds one uint32 count per (bin, class), each feature only getting as many bins as it has bin values,
+# e.g. 500 access points with 100 RSSI values each and 200 rooms take 40 MB per leaf, so with that many
+# features and classes lower max_bins or max_depth to bound the memory of a growing tree
+# a leaf splits when the Hoeffding bound shows its best split beats the best split on any other feature
+# with probability 1 - delta, or when the two are too close to matter (tie_threshold)
+# each incremental tree stores:
+#   1. root: the tree, usable with predict, prune_node and everything else that takes a Node tree
+#   2. bin_values: for each feature, the largest value in each bin (see bin_dataset)
+#   3. classes: sorted labels the tree can learn
+#   4. criterion, grace_period, delta, tie_threshold, max_depth: split settings, see incremental_tree_learning
+class IncrementalTree:
+    def __init__(self, bin_values, classes, root=None, criterion="entropy", grace_period=200, delta=1e-7,
+                 tie_threshold=0.05, max_depth=None):
+        self.bin_values = bin_values
+        self.classes = np.asarray(classes)
+        self.criterion = get_criterion(criterion)
+        self.grace_period = grace_period
+        self.delta = delta
+        self.tie_threshold = tie_threshold
+        self.max_depth = max_depth
+        self.offsets, self.bin_features = bin_offsets(bin_values)
+        if root is None:
+            root = Node(None, None, depth = 0, label = int(self.classes[0]), class_counts = {})
+        self.root = root
+
+    # absorbs a batch of labelled rows
+    # input:
+    #   - batch: (rows x columns) array, label in the last column
+    # returns the number of leaves that were split
+    def update(self, batch):
+        labels = np.searchsorted(self.classes, batch[:, -1].astype(int))
+        if np.any(self.classes[np.minimum(labels, len(self.classes) - 1)] != batch[:, -1].astype(int)):
+            raise ValueError(f"batch has labels outside of {self.classes.tolist()}")
+
+        # values outside the range of the bins fall in the first or last bin
+        codes = bin_codes(batch, self.bin_values)
+        return self.update_node(self.root, batch, codes, labels)
+
+    # routes rows down a subtree, adding them to the class counts of every node they pass, and updates the
+    # statistics of the leaves they reach
+    # counted: the rows are already in the class counts, as when a split hands them on to the new children
+    # returns the number of leaves that were split
+    def update_node(self, node, rows, codes, labels, counted=False):
+        if len(rows) == 0:
+            return 0
+        n_bins, n_classes = len(self.bin_features), len(self.classes)
+        if not counted:
+            class_counts = np.bincount(labels, minlength=n_classes)
+            for k in np.flatnonzero(class_counts):
+                label = int(self.classes[k])
+                node.class_counts[label] = node.class_counts.get(label, 0) + int(class_counts[k])
+        if node.label is None:
+            go_left = rows[:, node.feature] <= node.split_val
+            return (self.update_node(node.left, rows[go_left], codes[go_left], labels[go_left], counted) +
+                    self.update_node(node.right, rows[~go_left], codes[~go_left], labels[~go_left], counted))
+
+        if node.stats is None:
+            node.stats = np.zeros((n_bins, n_classes), dtype=np.uint32)
+        seen_before = int(node.stats[:len(self.bin_values[0])].sum())
+        node.stats += class_histogram(codes, labels, slice(None), self.offsets, n_bins, n_classes).astype(np.uint32)
+        node.label = majority_label(node.class_counts)
+
+        # only check for a split once every grace_period rows
+        seen = seen_before + len(rows)
+        if seen // self.grace_period == seen_before // self.grace_period:
+            return 0
+        if self.max_depth is not None and node.depth >= self.max_depth:
+            return 0
+        if not self.try_split(node):
+            return 0
+
+        # the rows of this batch carry on into the statistics of the new children, whose class counts
+        # already include them
+        return 1 + self.update_node(node, rows, codes, labels, counted=True)
+
+    # splits a leaf if the Hoeffding bound allows it
+    # returns whether the leaf was split
+    def try_split(self, leaf):
+        histogram = leaf.stats.astype(np.int64)
+        class_counts = histogram[:len(self.bin_values[0])].sum(axis=0)
+        n_rows = class_counts.sum()
+        if np.count_nonzero(class_counts) <= 1:
+            return False
+
+        # impurity of every candidate of every feature, empty bins are no candidate
+        # the running sum over all bins is restarted at each feature by taking off the rows of earlier features
+        n_features, n_classes = len(self.bin_values), len(self.classes)
+        left_counts = np.cumsum(histogram, axis=0) - self.bin_features[:, None] * class_counts
+        impurities = self.criterion.split_impurities(left_counts, left_counts.sum(axis=1), class_counts, n_rows)
+        impurities = np.where(histogram.sum(axis=1) > 0, impurities, np.inf)
+
+        # gain of the best split of each feature, compare the best two features
+        parent = self.criterion.impurity(class_counts)
+        gains = parent - np.minimum.reduceat(impurities, self.offsets)
+        ranked = np.argsort(gains)[::-1]
+        best_gain = gains[ranked[0]]
+        second_gain = gains[ranked[1]] if n_features > 1 else 0.0
+        bound = self.criterion.max_impurity(n_classes) * np.sqrt(np.log(1 / self.delta) / (2 * n_rows))
+        if best_gain <= 0 or (best_gain - second_gain <= bound and bound >= self.tie_threshold):
+            return False
+
+        feature = ranked[0]
+        first = self.offsets[feature]
+        split_bin = np.argmin(impurities[first:first + len(self.bin_values[feature])])
+        left = left_counts[first + split_bin]
+        if left.sum() == n_rows:
+            return False
+
+        # rows the leaf counted before it had statistics (from the first batch, or before its parent split) have
+        # no bin codes, they are shared between the children in the proportions of the split
+        earlier = np.array([leaf.class_counts.get(int(label), 0) for label in self.classes]) - class_counts
+        shares = np.where(class_counts > 0, left / np.maximum(class_counts, 1), left.sum() / n_rows)
+        left = left + np.round(earlier * shares).astype(np.int64)
+        right = class_counts + earlier - left
+
+        # the children start with the class counts of their side, and no statistics
+        leaf.feature, leaf.split_val, leaf.label, leaf.stats = int(feature), self.bin_values[feature][split_bin], None, None
+        leaf.left = Node(None, None, depth = leaf.depth + 1, class_counts = count_map(self.classes, left))
+        leaf.right = Node(None, None, depth = leaf.depth + 1, class_counts = count_map(self.classes, right))
+        leaf.left.label, leaf.right.label = majority_label(leaf.left.class_counts), majority_label(leaf.right.class_counts)
+        if profiler is not None:
+            profiler.count("nodes_built", 2)
+        return True
+
+
+# starts an IncrementalTree on a first batch of labelled rows, which also fixes the bins and the labels
+# the Hoeffding bound needs thousands of rows per leaf before it splits, so by default the first batch is
+# learnt in one go by decision_tree_learning_histogram and only later batches are absorbed incrementally
+# inputs:
+#    - dataset: first batch, label in the last column
+#    - classes: every label the tree will ever see, by default the labels of the first batch
+#    - max_bins: maximum number of bins per feature, at most 256
+#    - criterion: "entropy", "gini" or a SplitCriterion
+#    - grace_period: rows a leaf absorbs between split checks
+#    - delta: allowed probability of choosing a different split than the whole data stream would
+#    - tie_threshold: split anyway once the Hoeffding bound falls below this
+#    - max_depth: leaves at this depth are never split, None for no limit
+#    - batch_tree: learn the first batch with decision_tree_learning_histogram, False grows the tree from a single
+#      leaf with the Hoeffding rule only
+# returns the IncrementalTree, call its update method with every new batch
+def incremental_tree_learning(dataset, classes=None, max_bins=256, criterion="entropy", grace_period=200, delta=1e-7,
+                              tie_threshold=0.05, max_depth=None, batch_tree=True):
+    _, bin_values = bin_dataset(dataset, max_bins)
+    if classes is None:
+        classes = np.unique(dataset[:, -1].astype(int))
+    root = decision_tree_learning_histogram(dataset, max_bins=max_bins, criterion=criterion) if batch_tree else None
+    tree = IncrementalTree(bin_values, np.unique(classes), root=root, criterion=criterion, grace_period=grace_period,
+                           delta=delta, tie_threshold=tie_threshold, max_depth=max_depth)
+    if not batch_tree:
+        tree.update(dataset)
+    return tree
+
+
+
+
+
 # use our decision tree, classify a datapoint
+# to classify many rows use predict, or FlatTree.traverse for the leaf of every row and the rows reaching every node
 # input:
 #   - datapoint: sample to classify
 #   - tree: our model used to classify the datapoint
@@ -169,6 +1454,429 @@ def compute_class(datapoint, tree):
 
 
 
+# rows traverse_rows walks down the tree together, see traverse_rows
+TRAVERSE_BLOCK_ROWS = 4
+
+
+# traverses a FlatTree for rows start..stop-1 of a matrix, compiled by numba when it is installed
+# the rows are walked down in blocks of TRAVERSE_BLOCK_ROWS that each step one level per iteration,
+# so the independent node and feature loads of the block overlap instead of waiting on each other
+# input:
+#   - feature, threshold, left, right: arrays of the FlatTree
+#   - X: (rows x features) matrix, may include the label column
+#   - start, stop: range of rows to traverse
+#   - leaves: written with the id of the leaf each row ends at
+#   - hits: incremented by the number of rows that pass through each node
+def traverse_rows(feature, threshold, left, right, X, start, stop, leaves, hits):
+    nodes = np.zeros(TRAVERSE_BLOCK_ROWS, dtype=np.intp)
+    for block in range(start, stop, TRAVERSE_BLOCK_ROWS):
+        n_rows = min(TRAVERSE_BLOCK_ROWS, stop - block)
+        for j in range(n_rows):
+            nodes[j] = 0
+        hits[0] += n_rows
+
+        # step every row of the block that has not reached a leaf down one level
+        active = True
+        while active:
+            active = False
+            for j in range(n_rows):
+                node = nodes[j]
+                if feature[node] >= 0:
+                    node = right[node] if X[block + j, feature[node]] > threshold[node] else left[node]
+                    hits[node] += 1
+                    nodes[j] = node
+                    active = True
+        for j in range(n_rows):
+            leaves[block + j] = nodes[j]
+
+
+# numpy fallback of traverse_rows, with the same arguments
+# all rows step down one level of the tree per iteration using vectorized masks
+def traverse_levels(feature, threshold, left, right, X, start, stop, leaves, hits):
+    node = np.zeros(stop - start, dtype=np.intp)
+    active = np.arange(stop - start)
+    rows = X[start:stop]
+    while active.size:
+        current = node[active]
+        hits += np.bincount(current, minlength=len(hits))
+
+        # rows that reached a leaf are done
+        internal = feature[current] >= 0
+        active, current = active[internal], current[internal]
+
+        go_left = rows[active, feature[current]] <= threshold[current]
+        node[active] = np.where(go_left, left[current], right[current])
+    leaves[start:stop] = node
+
+
+# the traversal kernel of FlatTree.traverse, traverse_rows compiled by numba without the GIL, so chunks
+# of rows can be traversed by threads in parallel, or traverse_levels if numba is not installed
+# numba is only imported and the kernel only compiled the first time a tree is traversed
+@functools.lru_cache(maxsize=None)
+def traversal_kernel():
+    try:
+        import numba
+    except ImportError:
+        return traverse_levels
+    return numba.njit(nogil=True, cache=True)(traverse_rows)
+
+
+# compiled form of a decision tree, stored as parallel numpy arrays indexed by node id
+# node 0 is the root, leaf nodes have feature -1 and no children (-1)
+# each node stores:
+#   1. feature: the feature to split on
+#   2. threshold: the split value, values less than or equal go left
+#   3. left: id of the left child
+#   4. right: id of the right child
+#   5. label: the class label, if leaf node only
+class FlatTree:
+    def __init__(self, feature, threshold, left, right, label):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.label = label
+
+    # routes every row of a matrix to its leaf in one pass, see traversal_kernel
+    # input:
+    #   - X: (rows x features) matrix, may include the label column
+    #   - workers: number of threads, each traverses its own chunk of the rows
+    # returns the id of the leaf each row ends at, and the number of rows that pass through each node
+    def traverse(self, X, workers=1):
+        kernel = traversal_kernel()
+        X = np.asarray(X)
+        arrays = [np.asarray(array) for array in (self.feature, self.threshold, self.left, self.right)]
+        bounds = fold_bounds(len(X), max(min(workers, len(X)), 1))
+        leaves = np.empty(len(X), dtype=np.intp)
+        hits = np.zeros((len(bounds) - 1, len(self.feature)), dtype=np.int64)
+
+        def traverse_chunk(k):
+            kernel(*arrays, X, bounds[k], bounds[k+1], leaves, hits[k])
+        if len(hits) == 1:
+            traverse_chunk(0)
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=len(hits)) as pool:
+                list(pool.map(traverse_chunk, range(len(hits))))
+
+        hits = hits.sum(axis=0)
+        if profiler is not None:
+            profiler.count("rows_routed", int(hits[arrays[0] >= 0].sum()))
+        return leaves, hits
+
+    # classify every row of a matrix at once
+    # input:
+    #   - X: (rows x features) matrix, may include the label column
+    #   - workers: number of threads, see traverse
+    # returns the predicted label of each row
+    def predict_batch(self, X, workers=1):
+        return self.label[self.traverse(X, workers)[0]]
+
+
+# compile a tree of Node objects into a FlatTree, numbering nodes in pre-order
+# input:
+#   - tree: root node of the decision tree
+# returns the compiled FlatTree
+def compile_tree(tree):
+    features, thresholds, lefts, rights, labels = [], [], [], [], []
+
+    # (node, id of parent, whether node is the left child)
+    stack = [(tree, -1, True)]
+    while stack:
+        node, parent, is_left = stack.pop()
+        node_id = len(features)
+        if parent >= 0:
+            if is_left:
+                lefts[parent] = node_id
+            else:
+                rights[parent] = node_id
+
+        lefts.append(-1)
+        rights.append(-1)
+        if node.label != None:
+            features.append(-1)
+            thresholds.append(0.0)
+            labels.append(node.label)
+        else:
+            features.append(node.feature)
+            thresholds.append(node.split_val)
+            labels.append(-1)
+            stack.append((node.right, node_id, False))
+            stack.append((node.left, node_id, True))
+
+    return FlatTree(np.array(features, dtype=np.intp), np.array(thresholds, dtype=np.float64),
+                    np.array(lefts, dtype=np.intp), np.array(rights, dtype=np.intp),
+                    np.array(labels, dtype=np.int64))
+
+
+# classify every datapoint of a dataset with a decision tree
+# input:
+#   - tree: Node tree, already compiled FlatTree or RandomForest
+#   - dataset: samples to classify
+# returns array of predicted labels
+def predict(tree, dataset):
+    if not isinstance(tree, (FlatTree, RandomForest)):
+        tree = compile_tree(tree)
+    return tree.predict_batch(dataset)
+
+
+# ensemble of decision trees trained on bootstrap samples, see train_random_forest
+# each forest stores:
+#   1. trees: the compiled FlatTree of each tree
+#   2. classes: sorted labels the trees vote for
+class RandomForest:
+    def __init__(self, trees, classes):
+        self.trees = trees
+        self.classes = classes
+
+    # classify every row of a matrix by majority vote of the trees, ties go to the smallest label
+    # input:
+    #   - X: (rows x features) matrix, may include the label column
+    # returns the predicted label of each row
+    def predict_batch(self, X):
+        n_classes = len(self.classes)
+        votes = np.zeros(len(X) * n_classes, dtype=np.int64)
+        row_offsets = np.arange(len(X)) * n_classes
+        for tree in self.trees:
+            votes += np.bincount(row_offsets + np.searchsorted(self.classes, tree.predict_batch(X)),
+                                 minlength=len(votes))
+        return self.classes[np.argmax(votes.reshape(len(X), n_classes), axis=1)]
+
+
+# trains one tree of a random forest on a bootstrap sample of the dataset
+# input:
+#   - dataset: the main dataset
+#   - seed: np.random.SeedSequence of this tree, draws both the bootstrap sample and the node features
+#   - max_features, max_depth, min_samples_split: passed on to decision_tree_learning_iterative
+# returns the compiled tree
+def train_forest_tree(dataset, seed, max_features, max_depth, min_samples_split):
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, len(dataset), size=len(dataset))
+    tree = decision_tree_learning_iterative(dataset[rows], max_depth=max_depth, min_samples_split=min_samples_split,
+                                            max_features=max_features, seed=rng)
+    return compile_tree(tree)
+
+
+# random forest (bagging with per-node random feature subsampling) of iterative decision trees
+# the trees are independent, so they are trained in parallel with run_folds, one task per tree
+# input:
+#   - dataset: label in the last column
+#   - n_trees: number of trees
+#   - max_features: features drawn for each node, "sqrt" for the square root of the number of features,
+#     None for every feature (plain bagging)
+#   - max_depth, min_samples_split: limits of each tree, see decision_tree_learning_iterative
+#   - seed: seed of the forest, the same seed gives the same forest for any number of workers
+#   - workers: number of processes to train the trees on
+# returns the RandomForest, usable with predict, evaluate_accuracy and calculate_confusion_matrix
+def train_random_forest(dataset, n_trees=100, max_features="sqrt", max_depth=None, min_samples_split=2,
+                        seed=None, workers=1):
+    if max_features == "sqrt":
+        max_features = max(1, int(np.sqrt(dataset.shape[1] - 1)))
+    seeds = np.random.SeedSequence(seed).spawn(n_trees)
+    trees = run_folds(train_forest_tree, dataset,
+                      [(tree_seed, max_features, max_depth, min_samples_split) for tree_seed in seeds], workers)
+    return RandomForest(trees, DatasetSchema(dataset).classes)
+
+
+# on-disk tree format: a fixed-size header followed by the FlatTree arrays, fixed-width and little endian,
+# 8 byte arrays first so every array is aligned in a memory map
+TREE_FILE_MAGIC = b"DTREE\0\0\0"
+TREE_FILE_VERSION = 1
+TREE_FILE_HEADER = np.dtype([("magic", "S8"), ("version", "<u4"), ("n_nodes", "<u4")])
+TREE_FILE_ARRAYS = [("threshold", "<f8"), ("label", "<i8"), ("feature", "<i4"), ("left", "<i4"), ("right", "<i4")]
+
+
+# saves a decision tree in the binary tree format, compiling it first if needed
+# input:
+#   - tree: Node tree or FlatTree
+#   - path: file to write
+def save_tree(tree, path):
+    if not isinstance(tree, FlatTree):
+        tree = compile_tree(tree)
+    header = np.array([(TREE_FILE_MAGIC, TREE_FILE_VERSION, len(tree.feature))], dtype=TREE_FILE_HEADER)
+    with open(path, "wb") as f:
+        f.write(header.tobytes())
+        for name, dtype in TREE_FILE_ARRAYS:
+            f.write(np.ascontiguousarray(getattr(tree, name), dtype=dtype).tobytes())
+
+
+# loads a tree saved by save_tree as a FlatTree whose arrays are read-only views of a memory map of the file
+# nothing is copied or parsed, so processes loading the same file share one copy through the page cache
+# input:
+#   - path: file written by save_tree
+# returns the FlatTree
+def load_tree(path):
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    if len(data) < TREE_FILE_HEADER.itemsize:
+        raise ValueError(f"{path} is not a tree file")
+    header = data[:TREE_FILE_HEADER.itemsize].view(TREE_FILE_HEADER)[0]
+    if header["magic"] != TREE_FILE_MAGIC.rstrip(b"\0"):
+        raise ValueError(f"{path} is not a tree file")
+    if header["version"] != TREE_FILE_VERSION:
+        raise ValueError(f"{path} has tree file version {header['version']}, expected {TREE_FILE_VERSION}")
+
+    n_nodes = int(header["n_nodes"])
+    offset = TREE_FILE_HEADER.itemsize
+    arrays = {}
+    for name, dtype in TREE_FILE_ARRAYS:
+        size = n_nodes * np.dtype(dtype).itemsize
+        if offset + size > len(data):
+            raise ValueError(f"{path} is truncated")
+        arrays[name] = data[offset:offset + size].view(dtype)
+        offset += size
+    return FlatTree(arrays["feature"], arrays["threshold"], arrays["left"], arrays["right"], arrays["label"])
+
+
+# connections the prediction server lets wait to be accepted, many phones may connect at once
+PREDICTION_SERVER_BACKLOG = 1024
+
+# asyncio prediction server for live scans, holding one model in memory
+# the protocol is one line per request over TCP or a Unix socket: the feature values separated by spaces
+# (extra values such as a label are ignored), answered by a line with the predicted label, in order, so
+# clients can pipeline many requests on one connection. A "stats" line is answered with the counters as JSON
+# rows arriving within batch_window seconds of each other are classified together with one predict_batch call
+# each server stores:
+#   1. model: FlatTree or RandomForest used to classify
+#   2. n_features: number of feature values each request needs
+#   3. batch_window, max_batch: how long a batch waits for more rows, and the most rows in one batch
+#   4. pending: rows waiting for the next batch, with their future and arrival time
+#   5. requests, batches, errors: counters since the server started
+#   6. latencies: seconds from arrival to prediction of the most recent requests
+class PredictionServer:
+    def __init__(self, model, n_features=None, batch_window=0.002, max_batch=1024, latency_window=10000):
+        if isinstance(model, (str, os.PathLike)):
+            model = load_tree(model)
+        elif not isinstance(model, (FlatTree, RandomForest)):
+            model = compile_tree(model)
+        if n_features is None:
+            trees = model.trees if isinstance(model, RandomForest) else [model]
+            n_features = max(int(tree.feature.max()) for tree in trees) + 1
+        self.model = model
+        self.n_features = max(n_features, 1)
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.pending = []
+        self.flush_handle = None
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=latency_window)
+        self.started = time.perf_counter()
+
+    # queues one row for the next batch
+    # returns a future resolved with its predicted label
+    def submit(self, row):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((row, future, time.perf_counter()))
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.batch_window, self.flush)
+        return future
+
+    # classifies every pending row with one vectorized traversal and resolves their futures
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+
+        labels = self.model.predict_batch(np.array([row for row, _, _ in batch]))
+        done = time.perf_counter()
+        for (_, future, arrived), label in zip(batch, labels):
+            if not future.cancelled():
+                future.set_result(int(label))
+            self.latencies.append(done - arrived)
+        self.requests += len(batch)
+        self.batches += 1
+
+    # counters since the server started, latencies over the most recent requests
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000
+        uptime = time.perf_counter() - self.started
+        return {"requests": self.requests, "batches": self.batches, "errors": self.errors,
+                "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+                "throughput": self.requests / uptime,
+                "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None}
+
+    # serves one connection, requests are read and answered concurrently so pipelined rows share batches
+    async def handle_client(self, reader, writer):
+        import asyncio
+        answers = asyncio.Queue()
+
+        async def write_answers():
+            while True:
+                answer = await answers.get()
+                if answer is None:
+                    break
+                if isinstance(answer, asyncio.Future):
+                    answer = str(await answer)
+                writer.write(answer.encode() + b"\n")
+                if answers.empty():
+                    await writer.drain()
+
+        writer_task = asyncio.create_task(write_answers())
+        try:
+            async for line in reader:
+                line = line.strip()
+                if not line:
+                    continue
+                if line == b"stats":
+                    await answers.put(json.dumps(self.stats()))
+                    continue
+                try:
+                    row = np.array(line.split()[:self.n_features], dtype=np.float64)
+                except ValueError:
+                    row = None
+                if row is None or len(row) < self.n_features:
+                    self.errors += 1
+                    await answers.put(f"error: expected {self.n_features} numeric feature values")
+                    continue
+                await answers.put(self.submit(row))
+            await answers.put(None)
+            await writer_task
+
+        # a client that disconnects or a server shutting down just ends the connection
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer_task.cancel()
+            writer.close()
+
+    # listens on a Unix socket if path is given, otherwise on host:port, until cancelled
+    async def serve(self, host="127.0.0.1", port=8765, path=None):
+        import asyncio
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handle_client, path=path, backlog=PREDICTION_SERVER_BACKLOG)
+        else:
+            server = await asyncio.start_server(self.handle_client, host, port, backlog=PREDICTION_SERVER_BACKLOG)
+        async with server:
+            await server.serve_forever()
+
+
+# runs a PredictionServer until interrupted
+# input:
+#   - model: Node tree, FlatTree, RandomForest or path of a file written by save_tree
+#   - host, port: TCP address to listen on, or
+#   - path: Unix socket to listen on instead
+#   - batch_window: seconds a batch waits for more rows, max_batch: most rows in one batch
+def run_prediction_server(model, host="127.0.0.1", port=8765, path=None, batch_window=0.002, max_batch=1024):
+    import asyncio
+    server = PredictionServer(model, batch_window=batch_window, max_batch=max_batch)
+    try:
+        asyncio.run(server.serve(host, port, path))
+    except KeyboardInterrupt:
+        pass
+
+
+
+
+
 # helper function to print the decision tree
 def printTree(trained_tree):
         if trained_tree.label == None:
@@ -187,50 +1895,151 @@ def printTree(trained_tree):
 # helper function to evaluate the accuracy of a given decision tree on a given dataset
 # returns the accuracy
 def evaluate_accuracy(tree, dataset):
-    accuracy = 0
-    for datapoint in dataset:
-        accuracy += int(compute_class(datapoint, tree) == datapoint[-1])
-    return accuracy / len(dataset)
+    return np.mean(predict(tree, dataset) == dataset[:, -1])
 
 # clean_tree = decision_tree_learning(clean_dataset, 0)
 # noisy_tree = decision_tree_learning(noisy_dataset, 0)
 
 # printTree(noisy_tree)
 
-# helper function to visualise decision tree in portrait, top down
-def plot_tree_top_down(node, depth=0, position=0, ax=None):
-    if ax is None:
-        fig, ax = plt.subplots(figsize=(200, 100))
-
-    # if current node is an internal node, plot split node, recurse children
-    if node.label is None:
-
-        # plot blue split node
-        ax.scatter(position, -depth, s=5000, c='blue', edgecolors='black', zorder=2)
-        ax.text(position, -depth, f"F{node.feature}\n<={node.split_val}", va='center', ha='center', color='white', fontsize=7, zorder=3)
+# walks a tree once in pre-order and lays it out top down without overlaps: leaves sit on consecutive
+# x positions left to right, and every decision node is centred above its children
+# nodes at max_depth that still have children are laid out as leaves and marked as truncated
+# input:
+#   - tree: root node of the subtree to lay out
+#   - max_depth: number of levels below the root to lay out, None for every level
+# returns the nodes in pre-order with their x and y (minus the level below the root), the index of the parent
+# of each node (-1 for the root) and whether each node was truncated
+def tree_layout(tree, max_depth=None):
+    nodes, parents, levels, truncated, x = [], [], [], [], []
+    next_leaf = 0
+
+    # pre-order visits the leaves from left to right, (node, level below the root, index of the parent)
+    stack = [(tree, 0, -1)]
+    while stack:
+        node, level, parent = stack.pop()
+        nodes.append(node)
+        parents.append(parent)
+        levels.append(level)
+        cut = node.label is None and max_depth is not None and level >= max_depth
+        truncated.append(cut)
+        if node.label is not None or cut:
+            x.append(float(next_leaf))
+            next_leaf += 1
+        else:
+            x.append(0.0)
+            stack.append((node.right, level + 1, len(nodes) - 1))
+            stack.append((node.left, level + 1, len(nodes) - 1))
+
+    # children come after their parent in pre-order, so one backwards pass centres every decision node
+    x, parents, truncated = np.array(x), np.array(parents), np.array(truncated, dtype=bool)
+    expanded = np.array([node.label is None for node in nodes]) & ~truncated
+    children_x = np.zeros(len(nodes))
+    for index in range(len(nodes) - 1, -1, -1):
+        if expanded[index]:
+            x[index] = children_x[index] / 2
+        if parents[index] >= 0:
+            children_x[parents[index]] += x[index]
+    return nodes, x, -np.array(levels, dtype=float), parents, truncated
+
+
+# follows a path of "L"/"R" steps from the root, e.g. to plot or export a zoomed in subtree
+def subtree(tree, path):
+    for step in path.upper():
+        if tree.label is not None:
+            raise ValueError(f"path {path!r} goes below a leaf")
+        tree = tree.left if step == "L" else tree.right
+    return tree
 
-        # recurse for left and right children
-        left_position = position - 1/(2**(depth+2))
-        right_position = position + 1/(2**(depth+2))
 
-        # connect children
-        ax.plot([position, left_position], [-depth, -depth-1], 'k-', zorder=1)
-        ax.plot([position, right_position], [-depth, -depth-1], 'k-', zorder=1)
+# helper function to visualise decision tree in portrait, top down
+# the layout is computed in one pass, and all edges are drawn as one LineCollection and all nodes as one scatter
+# blue nodes split, green nodes are labels and grey nodes have been cut off by max_depth
+# input:
+#   - node: root of the tree, or of a subtree to zoom in on (see subtree)
+#   - ax: axes to draw on, a new figure sized to the tree if None
+#   - max_depth: number of levels to draw, None for every level
+#   - show_text: write the split or label in every node, by default only when there are at most text_limit nodes
+#   - text_limit: most nodes that get text by default
+# returns the axes
+def plot_tree_top_down(node, ax=None, max_depth=None, show_text=None, text_limit=256):
+    from matplotlib.collections import LineCollection
+
+    nodes, x, y, parents, truncated = tree_layout(node, max_depth)
+    if ax is None:
+        n_leaves = int(x.max()) + 1
+        fig, ax = pyplot().subplots(figsize=(min(4 + 0.6 * n_leaves, 200), min(2 + 0.8 * (1 - y.min()), 100)))
+
+    children = np.flatnonzero(parents >= 0)
+    segments = np.stack([np.column_stack((x[parents[children]], y[parents[children]])),
+                         np.column_stack((x[children], y[children]))], axis=1)
+    ax.add_collection(LineCollection(segments, colors='k', linewidths=0.8, zorder=1))
+
+    is_leaf = np.array([n.label is not None for n in nodes])
+    colors = np.where(is_leaf, 'green', np.where(truncated, 'grey', 'blue'))
+    ax.scatter(x, y, s=400 if len(nodes) <= text_limit else 20, c=colors, edgecolors='black', zorder=2)
+
+    if show_text is None:
+        show_text = len(nodes) <= text_limit
+    if show_text:
+        for n, xi, yi, cut in zip(nodes, x, y, truncated):
+            if n.label is not None:
+                text, color = f"Label {n.label}", 'black'
+            else:
+                text, color = (f"F{n.feature}\n<={n.split_val}" + ("\n..." if cut else "")), 'black' if cut else 'white'
+            ax.text(xi, yi, text, va='center', ha='center', color=color, fontsize=7, zorder=3)
+
+    ax.set_xlim(x.min() - 1, x.max() + 1)
+    ax.set_ylim(y.min() - 1, 1)
+    ax.axis('off')
+    return ax
 
-        plot_tree_top_down(node.left, depth+1, left_position, ax)
-        plot_tree_top_down(node.right, depth+1, right_position, ax)
 
-    # if leaf (label) node, plot this in green
-    else:
-        # add green class/label leaf node
-        ax.scatter(position, -depth, s=5000, c='green', edgecolors='black', zorder=2)
-        ax.text(position, -depth, f"Label {node.label}", va='center', ha='center', color='black', fontsize=7, zorder=3)
+# exports a tree as indented text, one line per node
+# input:
+#   - tree: root node, or a subtree (see subtree)
+#   - max_depth: number of levels to export, deeper subtrees are written as "..."
+# returns the text
+def tree_to_text(tree, max_depth=None):
+    nodes, _, y, _, truncated = tree_layout(tree, max_depth)
+    lines = []
+    for node, level, cut in zip(nodes, -y.astype(int), truncated):
+        indent = "|   " * level
+        if node.label is not None:
+            lines.append(f"{indent}label {node.label}  {node.class_counts or ''}".rstrip())
+        elif cut:
+            lines.append(f"{indent}F{node.feature} <= {node.split_val} ...")
+        else:
+            lines.append(f"{indent}F{node.feature} <= {node.split_val}")
+    return "\n".join(lines)
 
-    ax.axis('off')
-    return ax
 
-# Plotting the sample tree top-down
+# exports a tree in Graphviz DOT format, e.g. for `dot -Tsvg tree.dot > tree.svg`
+# the left edge of every split is labelled true (value <= split), the right edge false
+# input:
+#   - tree: root node, or a subtree (see subtree)
+#   - max_depth: number of levels to export, deeper subtrees are drawn as a grey "..." node
+# returns the DOT source
+def tree_to_dot(tree, max_depth=None):
+    nodes, _, _, parents, truncated = tree_layout(tree, max_depth)
+    lines = ["digraph tree {", '    node [shape=box, style="rounded,filled", fontname=helvetica];']
+    for i, (node, parent, cut) in enumerate(zip(nodes, parents, truncated)):
+        if node.label is not None:
+            lines.append(f'    {i} [label="label {node.label}", fillcolor=palegreen];')
+        elif cut:
+            lines.append(f'    {i} [label="F{node.feature} <= {node.split_val}\\n...", fillcolor=lightgrey];')
+        else:
+            lines.append(f'    {i} [label="F{node.feature} <= {node.split_val}", fillcolor=lightblue];')
+        if parent >= 0:
+            is_left = nodes[parent].left is node
+            lines.append(f'    {parent} -> {i} [label="{"true" if is_left else "false"}"];')
+    lines.append("}")
+    return "\n".join(lines)
+
+# Plotting the sample tree top-down, or only its top 5 levels, or the right subtree of its left child
 # plot_tree_top_down(clean_tree)
+# plot_tree_top_down(noisy_tree, max_depth=5)
+# plot_tree_top_down(subtree(noisy_tree, "LR"))
 # plt.show()
 
 # # sanity checks
@@ -241,46 +2050,168 @@ def plot_tree_top_down(node, depth=0, position=0, ax=None):
 # input:
 #   - dataset
 #   - decision tree
+#   - classes: sorted labels of the rows and columns, by default every label in the dataset or predicted
+# returns confusion matrix
+def calculate_confusion_matrix(dataset, trained_tree, classes=None):
+    predictions = predict(trained_tree, dataset)
+    truth = dataset[:, -1].astype(int)
+    if classes is None:
+        classes = np.union1d(truth, predictions)
+    return confusion_matrix_from_labels(truth, predictions, classes)
+
+
+# confusion matrix from true and predicted labels with a single bincount, rows are true and columns predicted labels
+# input:
+#   - truth, predictions: label of each row
+#   - classes: sorted labels of the rows and columns
 # returns confusion matrix
-def calculate_confusion_matrix(dataset, trained_tree):
+def confusion_matrix_from_labels(truth, predictions, classes):
+    n_classes = len(classes)
+    cells = np.searchsorted(classes, truth) * n_classes + np.searchsorted(classes, predictions)
+    return np.bincount(cells, minlength=n_classes * n_classes).reshape(n_classes, n_classes)
 
-    # initialise matrix
-    confusion_matrix = [[0, 0, 0, 0] for i in range(4)]
 
-    # calculate each value for the matrix
-    for datapoint in dataset:
-        prediction = compute_class(datapoint, trained_tree)
-        confusion_matrix[int(datapoint[-1]) - 1][prediction - 1] += 1
-    return np.array(confusion_matrix)
+# every metric of the report from a confusion matrix, or from a stack of them (one per fold, as the first axis)
+# with one label per row, micro averaged precision, recall and F1 are all equal to the accuracy
+# macro averages skip classes whose metric is undefined (nan, no rows predicted or true)
+# input:
+#   - confusion_matrix: (classes x classes) or (folds x classes x classes)
+# returns hashmap from metric -> value, per class metrics have the classes as the last axis
+def confusion_metrics(confusion_matrix):
+    confusion_matrix = np.asarray(confusion_matrix, dtype=np.float64)
+    correct = np.diagonal(confusion_matrix, axis1=-2, axis2=-1)
+    accuracy = correct.sum(axis=-1) / confusion_matrix.sum(axis=(-2, -1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precisions = correct / confusion_matrix.sum(axis=-2)
+        recalls = correct / confusion_matrix.sum(axis=-1)
+        f1_measures = 2 * precisions * recalls / (precisions + recalls)
+
+    return {"accuracy": accuracy, "precision": precisions, "recall": recalls, "f1": f1_measures,
+            "macro_precision": np.nanmean(precisions, axis=-1), "macro_recall": np.nanmean(recalls, axis=-1),
+            "macro_f1": np.nanmean(f1_measures, axis=-1),
+            "micro_precision": accuracy, "micro_recall": accuracy, "micro_f1": accuracy}
+
+
+# mean and variance across folds of every metric of confusion_metrics
+# input:
+#   - confusion_matrices: confusion matrix of each fold
+# returns hashmap from metric -> {"mean": ..., "var": ...}
+def fold_metrics(confusion_matrices):
+    metrics = confusion_metrics(np.stack(confusion_matrices))
+    return {name: {"mean": values.mean(axis=0), "var": values.var(axis=0)} for name, values in metrics.items()}
 
 # get the confusion matrix of the full clean dataset
 # confusion_matrix = calculate_confusion_matrix(clean_dataset, clean_tree)
 
+# matplotlib is only imported when something is drawn, so importing this module for inference stays fast
+# returns matplotlib.pyplot
+def pyplot():
+    import matplotlib.pyplot as plt
+    return plt
+
+
+# writes report figures and data to a directory in a background thread, instead of showing them
+# figures are plain matplotlib Figures rendered with the Agg canvas, so nothing touches pyplot or a display,
+# and the caller carries on while the previous files are still being written
+# each report writer stores:
+#   1. directory: where the files are written
+#   2. pool: single background thread doing the writing, in submission order
+#   3. pending: futures of the writes not yet waited for
+class ReportWriter:
+    def __init__(self, directory):
+        from concurrent.futures import ThreadPoolExecutor
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+
+    # new figure and axes that are not managed by pyplot
+    def figure(self, figsize=None):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        return fig, fig.add_subplot()
+
+    # writes a figure to <name>.png
+    def save_figure(self, name, fig, dpi=150):
+        path = os.path.join(self.directory, name + ".png")
+        self.pending.append(self.pool.submit(fig.savefig, path, dpi=dpi, bbox_inches='tight'))
+
+    # writes data to <name>.json, numpy arrays and numbers are converted to lists and floats
+    def save_json(self, name, data):
+        path = os.path.join(self.directory, name + ".json")
+
+        def write():
+            with open(path, "w") as f:
+                json.dump(data, f, indent=2, default=lambda value: value.tolist() if hasattr(value, "tolist") else str(value))
+        self.pending.append(self.pool.submit(write))
+
+    # waits for every write, raising the first error
+    def close(self):
+        for future in self.pending:
+            future.result()
+        self.pending = []
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# new figure and axes, from the report writer if there is one, otherwise from pyplot to be shown
+def report_figure(report, figsize=None):
+    if report is not None:
+        return report.figure(figsize)
+    return pyplot().subplots(figsize=figsize)
+
+
+# shows a figure, or hands it to the report writer as <name>.png
+def finish_figure(report, name, fig):
+    if report is not None:
+        report.save_figure(name, fig)
+    else:
+        pyplot().show()
+
+
+# file name for a report figure from its title
+def report_name(title):
+    return "".join(c if c.isalnum() else "_" for c in title.lower()).strip("_")
+
+
 # helper function to take a confusion matrix as a 2-d array and display it nicely
-def displayCF(confusion_matrix):
+# labels default to 1..K, as in wifi_db
+# with a ReportWriter the figure is written to a PNG file instead of shown
+def displayCF(confusion_matrix, labels=None, report=None, name="Confusion Matrix"):
+    n_classes = len(confusion_matrix)
+    if labels is None:
+        labels = list(range(1, n_classes + 1))
 
     # print the input matrix
     print(confusion_matrix)
-    plt.imshow(confusion_matrix, cmap='Blues')
+    fig, ax = report_figure(report)
+    image = ax.imshow(confusion_matrix, cmap='Blues')
 
     # title, axes and colour bar on the side
-    plt.title('Confusion Matrix')
-    plt.xlabel('Predicted Label')
-    plt.ylabel('True Label')
-    plt.colorbar()
+    ax.set_title(name)
+    ax.set_xlabel('Predicted Label')
+    ax.set_ylabel('True Label')
+    fig.colorbar(image)
 
     # labels
-    plt.xticks(np.arange(4), [1, 2, 3, 4])
-    plt.yticks(np.arange(4), [1, 2, 3, 4])
+    ax.set_xticks(np.arange(n_classes), labels)
+    ax.set_yticks(np.arange(n_classes), labels)
     threshold = 0.7 * np.max(confusion_matrix)
 
     # styling
-    for i in range(4):
-        for j in range(4):
+    for i in range(n_classes):
+        for j in range(n_classes):
             color = 'white' if confusion_matrix[i, j] > threshold else 'black'
             formatted_value = f"{confusion_matrix[i, j]:.1f}"
-            plt.text(j, i, formatted_value, ha='center', va='center', color=color)
-    plt.show()
+            ax.text(j, i, formatted_value, ha='center', va='center', color=color)
+    finish_figure(report, report_name(name), fig)
 
 # displayCF(confusion_matrix)
 
@@ -290,16 +2221,7 @@ def displayCF(confusion_matrix):
 #   - trained_tree: decision tree to test
 # returns accuracy, precision, recall, f1
 def compute_metrics(test_db, trained_tree):
-    confusion_matrix = calculate_confusion_matrix(test_db, trained_tree)
-    true_values = sum(confusion_matrix[i][i] for i in range(4))
-    accuracy = true_values / confusion_matrix.sum()
-    precisions = np.array([confusion_matrix[i][i] for i in range(4)]) / confusion_matrix.sum(axis = 0)
-    recalls = np.array([confusion_matrix[i][i] for i in range(4)]) / confusion_matrix.sum(axis = 1)
-    f1_mesaures = 2 * precisions * recalls / (precisions + recalls)
-    return [accuracy, precisions, recalls, f1_mesaures]
-
-
-
+    return compute_metrics_cf(calculate_confusion_matrix(test_db, trained_tree))
 
 
 # also computes all metrics that are needed for the report
@@ -308,12 +2230,8 @@ def compute_metrics(test_db, trained_tree):
 #   - confusion_matrix: confusion matrix of decision tree to evaluate
 # returns accuracy, precision, recall, f1
 def compute_metrics_cf(confusion_matrix):
-    true_values = sum(confusion_matrix[i][i] for i in range(4))
-    accuracy = true_values / confusion_matrix.sum()
-    precisions = np.array([confusion_matrix[i][i] for i in range(4)]) / confusion_matrix.sum(axis = 0)
-    recalls = np.array([confusion_matrix[i][i] for i in range(4)]) / confusion_matrix.sum(axis = 1)
-    f1_mesaures = 2 * precisions * recalls / (precisions + recalls)
-    return [accuracy, precisions, recalls, f1_mesaures]
+    metrics = confusion_metrics(confusion_matrix)
+    return [metrics["accuracy"], metrics["precision"], metrics["recall"], metrics["f1"]]
 
 
 
@@ -324,8 +2242,12 @@ def compute_metrics_cf(confusion_matrix):
 #   - precisions: precision value for each class
 #   - recalls: recall value for each class
 #   - f1_measures: f1 measure for each class
+#   - labels: class labels, 1..K by default
+#   - report: ReportWriter to write the table to as a PNG file instead of showing it
 # returns nothing but displays table when called
-def display_metrics_table(name, accuracy, precisions, recalls, f1_measures):
+def display_metrics_table(name, accuracy, precisions, recalls, f1_measures, labels=None, report=None):
+    if labels is None:
+        labels = list(range(1, len(precisions) + 1))
     print("Accuracy: ", accuracy)
     print("Precisions: ", precisions)
     print("Recalls: ", recalls)
@@ -334,22 +2256,13 @@ def display_metrics_table(name, accuracy, precisions, recalls, f1_measures):
     precisions = [round(p, 3) for p in precisions]
     recalls = [round(r, 3) for r in recalls]
     f1_measures = [round(f, 3) for f in f1_measures]
-    fig, ax = plt.subplots()
+    fig, ax = report_figure(report)
     ax.axis('off')
     ax.axis('tight')
-    table = ax.table(cellText=[["Accuracy", accuracy],
-                               ["Precision 1", precisions[0]],
-                               ["Precision 2", precisions[1]],
-                               ["Precision 3", precisions[2]],
-                               ["Precision 4", precisions[3]],
-                               ["Recall 1", recalls[0]],
-                               ["Recall 2", recalls[1]],
-                               ["Recall 3", recalls[2]],
-                               ["Recall 4", recalls[3]],
-                               ["F1 Measure 1", f1_measures[0]],
-                               ["F1 Measure 2", f1_measures[1]],
-                               ["F1 Measure 3", f1_measures[2]],
-                               ["F1 Measure 4", f1_measures[3]]],
+    table = ax.table(cellText=[["Accuracy", accuracy]] +
+                              [[f"Precision {label}", p] for label, p in zip(labels, precisions)] +
+                              [[f"Recall {label}", r] for label, r in zip(labels, recalls)] +
+                              [[f"F1 Measure {label}", f] for label, f in zip(labels, f1_measures)],
                 colLabels=["Metric", "Value"],
                 cellLoc='center',
                 loc='center')
@@ -363,51 +2276,124 @@ def display_metrics_table(name, accuracy, precisions, recalls, f1_measures):
     table.set_fontsize(10)
     table.scale(1, 1.5)
 
-    plt.title(name)
-    plt.show()
+    ax.set_title(name)
+    finish_figure(report, report_name(name), fig)
 
-# performs 10-fold cross validation for our decision tree learning algorithm
+# dataset and arguments shared by every fold, attached once per worker process of run_folds
+shared_dataset = None
+shared_dataset_memory = None
+shared_arguments = ()
+
+# worker initialiser, attaches to the shared memory block holding the dataset
+# input:
+#   - name: name of the shared memory block
+#   - shape, dtype: shape and dtype of the dataset stored in it
+#   - arguments: arguments every fold gets after the dataset, e.g. the schema and fold order
+def attach_shared_dataset(name, shape, dtype, arguments=()):
+    from multiprocessing import shared_memory
+    global shared_dataset, shared_dataset_memory, shared_arguments
+    shared_dataset_memory = shared_memory.SharedMemory(name=name)
+    shared_dataset = np.ndarray(shape, dtype=dtype, buffer=shared_dataset_memory.buf)
+    shared_dataset.flags.writeable = False
+    shared_arguments = arguments
+
+# runs one fold in a worker process on the shared dataset
+def run_shared_fold(fold_function, fold):
+    return fold_function(shared_dataset, *shared_arguments, *fold)
+
+# runs a fold function for every fold, in parallel if more than one worker is asked for
+# the dataset is copied once into shared memory, and the arguments common to every fold are handed to each
+# worker once when it starts, so a task only carries its own small fold arguments
+# input:
+#   - fold_function: function taking the dataset, the common arguments and then the fold arguments
+#   - dataset
+#   - folds: list of argument tuples, one per fold
+#   - workers: number of worker processes, 1 runs every fold in this process
+#   - profile: run every fold with its own Profiler active
+#   - arguments: arguments common to every fold, e.g. (schema, order)
+# returns the results of each fold, in the order of folds, paired with the profiler report of the fold if profile
+def run_folds(fold_function, dataset, folds, workers=1, profile=False, arguments=()):
+    if profile:
+        fold_function = functools.partial(profiled_fold, fold_function)
+    if workers <= 1:
+        return [fold_function(dataset, *arguments, *fold) for fold in folds]
+
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory
+    memory = shared_memory.SharedMemory(create=True, size=dataset.nbytes)
+    try:
+        np.ndarray(dataset.shape, dtype=dataset.dtype, buffer=memory.buf)[:] = dataset
+        with ProcessPoolExecutor(max_workers=workers, initializer=attach_shared_dataset,
+                                 initargs=(memory.name, dataset.shape, dataset.dtype.str, arguments)) as pool:
+            return list(pool.map(run_shared_fold, [fold_function] * len(folds), folds))
+    finally:
+        memory.close()
+        memory.unlink()
+
+# trains and tests the tree of a single fold of tenfold
 # input:
 #   - dataset
-# returns the averaged confusion matrix and average accuracy
-def tenfold(dataset):
+#   - schema: DatasetSchema of the dataset
+#   - order: order of the rows, see fold_order
+#   - i: index of the test fold
+# returns the accuracy and confusion matrix on the test fold
+def tenfold_fold(dataset, schema, order, i):
+
+    # split the data into train and test folds
+    bounds = fold_bounds(len(order), 10)
+    with profile_stage("copy"):
+        train = dataset[np.r_[order[:bounds[i]], order[bounds[i+1]:]]]
+
+    # train tree based on training folds
+    with profile_stage("train"):
+        trained_tree = decision_tree_learning(train, 0)
 
-    # shuffle the dataset e.g. because noisy dataset is sorted by class value
-    np.random.shuffle(dataset)
+    # test the tree on test fold
+    # the accuracy comes from the confusion matrix, so the test fold is only classified once
+    test_db = dataset[order[bounds[i]: bounds[i+1]]]
+    with profile_stage("evaluate"):
+        cf = calculate_confusion_matrix(test_db, trained_tree, schema.classes)
+    return np.trace(cf) / len(test_db), cf
 
-    # store accuracy and cf for each folds tree
-    accuracies = []
-    confusion_matrices = []
+# performs 10-fold cross validation for our decision tree learning algorithm
+# input:
+#   - dataset
+#   - workers: number of processes to run the folds on
+#   - profile: collect counters and timers for each fold, see Profiler
+#   - summary: also return the mean and variance across folds of every metric, see fold_metrics
+#   - seed: seed of the folds, see fold_order
+#   - stratified: give every fold close to the same share of each class
+# returns the averaged confusion matrix and average accuracy, followed by the fold metrics if summary
+# and the profiler report of each fold if profile
+def tenfold(dataset, workers=1, profile=False, summary=False, seed=None, stratified=False):
+
+    # folds are drawn in random order e.g. because noisy dataset is sorted by class value
+    # they are index arrays into the dataset, which is never shuffled or changed
+    dataset = read_only(dataset)
+    schema = DatasetSchema(dataset)
+    order = fold_order(len(dataset), 10, seed, schema.encode(dataset[:, -1]) if stratified else None)
 
     # for each of the 10 folds, create a model and test it
-    for i in range(10):
+    results = run_folds(tenfold_fold, dataset, [(i,) for i in range(10)], workers, profile, (schema, order))
+    if profile:
+        reports = [dict(report, fold=i) for i, (_, report) in enumerate(results)]
+        results = [result for result, _ in results]
 
-        # split the data into train and test folds
-        train = np.append(dataset[:i * 200], dataset[(i+1) * 200:], axis=0)
-
-        # train tree based on training folds
-        trained_tree = decision_tree_learning(train, 0)
-
-        # test the tree on test fold
-        test_db = dataset[i * 200: (i+1) * 200]
-        correct =  0
-        for test_point in test_db:
-            if compute_class(test_point, trained_tree) == test_point[-1]:
-                correct += 1
-        accuracies.append(correct / 200)
-
-        cf = calculate_confusion_matrix(test_db, trained_tree)
-        confusion_matrices.append(cf)
+    # store accuracy and cf for each folds tree
+    accuracies = [accuracy for accuracy, _ in results]
+    confusion_matrices = np.stack([cf for _, cf in results])
 
     # get the average confusion matrix by element-wise operations
-    summed_matrix = np.zeros((4, 4))
-    for matrix in confusion_matrices:
-        summed_matrix += matrix
-    average_cf = summed_matrix / len(confusion_matrices)
+    average_cf = confusion_matrices.sum(axis=0) / len(confusion_matrices)
 
     average_accruacy = np.mean(accuracies)
 
-    return average_cf, average_accruacy
+    returns = (average_cf, average_accruacy)
+    if summary:
+        returns += (fold_metrics(confusion_matrices),)
+    if profile:
+        returns += (reports,)
+    return returns
 
 
 
@@ -429,26 +2415,15 @@ def evaluate(test_db, trained_tree):
 # accuracy, precisions, recalls, f1_measures = compute_metrics_cf(noisy_cf)
 # display_metrics_table("Noisy Tenfold", accuracy, precisions, recalls, f1_measures)
 
+# random forest on the noisy dataset, reported like the pruned trees
+# forest = train_random_forest(noisy_dataset[:1800], n_trees=100, seed=0, workers=os.cpu_count())
+# cf = calculate_confusion_matrix(noisy_dataset[1800:], forest)
+# display_metrics_table("Noisy Forest", *compute_metrics_cf(cf))
+
 # # sanity check: clean tree metrics for pure model
 # compute_metrics(clean_dataset, clean_tree)
 # display_metrics_table("Clean", *compute_metrics(clean_dataset, clean_tree))
 
-# use our decision tree, classify a datapoint for the pruned sets
-# input:
-#   - datapoint: sample to classify
-#   - tree: our model used to classify the datapoint
-#   - leaf_map_count: map of leaf node -> number of training examples in that leaf node label
-# returns predicted label of the datapoint
-def compute_class_prune(datapoint, tree, leaf_map_count):
-    if tree.label != None:
-        if not tree in leaf_map_count: leaf_map_count[tree] = 0
-        leaf_map_count[tree] += 1
-    else:
-        if datapoint[tree.feature] <= tree.split_val:
-            return compute_class_prune(datapoint, tree.left, leaf_map_count)
-        else:
-            return compute_class_prune(datapoint, tree.right, leaf_map_count)
-
 # helper function to compute and return depth of tree recursively
 def depth(tree):
     if tree.label != None: return 0
@@ -456,138 +2431,438 @@ def depth(tree):
 
 # depth(clean_tree)
 
-# nested 10-fold cross validation using pruning with decision trees
-# produces 90 trees overall
+# trains and prunes the tree of a single inner fold of prune
+# decision_tree_learning sorts the rows it is given, so every inner tree trains on its own gathered copy of
+# its training rows, prune with presorted=True builds from index views of one presort per outer fold instead
 # input:
 #   - dataset
-# returns the average confusion matrix, depth information and accuracy pre and post pruning
-def prune(dataset):
-    
-    np.random.shuffle(dataset)
-
-    # variables to track, process and return
-    depth_before = 0
-    depth_after = 0
-    accuracies_before = []
-    accuracies_after = []
-    confusion_matrices = []
-
-    # split the dataset into a train_and_validation set, and a test_dataset 10 times
-    # train each of these 9 times using train set and validation set to test / tune
-    for i in range(10):
-        train_and_validation = np.append(dataset[:i * 200], dataset[(i+1) * 200:], axis=0)
-        test_dataset = dataset[i * 200: (i+1) * 200]
-
-        # perform pruning over 8 train folds and evaluate / tune using validation fold
-        for val_index in range(9):
-
-            # split the train_and_validation set into the train dataset and a validation set
-            train = np.append(train_and_validation[:val_index * 200], train_and_validation[(val_index+1) * 200:], axis=0)
-            validation_set = train_and_validation[val_index * 200: (val_index+1) * 200]
-
-            # create decision tree
-            trained_tree = decision_tree_learning(train, 0)
-            depth_before += depth(trained_tree)
-            leaf_map_count = {}
-
-            # for each leaf, compute the number of example training points that enter that leaf
-            for training_point in train:
-                compute_class_prune(training_point, trained_tree, leaf_map_count)
-
-            # accuracy before pruning
-            accuracy = evaluate_accuracy(trained_tree, validation_set) # compute the accuracy before any pruning
-            accuracy_before = accuracy
+#   - schema: DatasetSchema of the dataset
+#   - order: order of the rows, see fold_order
+#   - i: index of the test fold
+#   - val_index: index of the validation fold within the remaining 9 folds
+#   - method: pruning method, see prune_and_test
+# returns the results of prune_and_test
+def prune_fold(dataset, schema, order, i, val_index, method="reduced_error"):
+    bounds = fold_bounds(len(order), 10)
+    test_dataset = dataset[order[bounds[i]: bounds[i+1]]]
+
+    # split the rows of the train_and_validation set into the train dataset and a validation set
+    outer_rows = np.r_[order[:bounds[i]], order[bounds[i+1]:]]
+    inner = fold_bounds(len(outer_rows), 9)
+    with profile_stage("copy"):
+        train = dataset[np.r_[outer_rows[:inner[val_index]], outer_rows[inner[val_index+1]:]]]
+    validation_set = dataset[outer_rows[inner[val_index]: inner[val_index+1]]]
+
+    # create decision tree
+    with profile_stage("train"):
+        trained_tree = decision_tree_learning(train, 0)
+    return prune_and_test(trained_tree, validation_set, test_dataset, schema.classes, method)
 
-            # perform pruning
-            pruned_tree, accuracy = prune_node(trained_tree, validation_set, trained_tree, leaf_map_count, accuracy) #prune the tree
+# trains and prunes the 9 inner trees of one outer fold of prune from a single presort
+# the outer training rows are sorted on every feature once, and each inner training set is
+# taken from those sorted indices by masking out its validation fold, so nothing is re-sorted or copied
+# input:
+#   - dataset
+#   - schema: DatasetSchema of the dataset
+#   - order: order of the rows, see fold_order
+#   - i: index of the test fold
+#   - method: pruning method, see prune_and_test
+# returns the results of prune_and_test for each of the 9 inner folds
+def prune_outer_fold(dataset, schema, order, i, method="reduced_error"):
+    labels = schema.encode(dataset[:, -1])
+    bounds = fold_bounds(len(order), 10)
+    test_dataset = dataset[order[bounds[i]: bounds[i+1]]]
+
+    # rows of the train_and_validation set, in the same order as prune_fold
+    outer_rows = np.r_[order[:bounds[i]], order[bounds[i+1]:]]
+    inner = fold_bounds(len(outer_rows), 9)
+    with profile_stage("sort"):
+        sorted_idx = outer_rows[np.argsort(dataset[outer_rows, :-1], axis=0, kind='stable')].T
+    outer_counts = np.bincount(labels[outer_rows], minlength=schema.n_classes)
+
+    in_train = np.zeros(len(dataset), dtype=bool)
+    goes_left = np.zeros(len(dataset), dtype=bool)
+    results = []
+    for val_index in range(9):
+        validation_rows = outer_rows[inner[val_index]: inner[val_index+1]]
+
+        # mask the validation fold out of the sorted indices and class counts
+        in_train[outer_rows] = True
+        in_train[validation_rows] = False
+        train_idx = sorted_idx[in_train[sorted_idx]].reshape(len(sorted_idx), -1)
+        class_counts = outer_counts - np.bincount(labels[validation_rows], minlength=schema.n_classes)
+
+        with profile_stage("train"):
+            trained_tree = build_presorted_node(dataset, schema.classes, labels, train_idx, goes_left, 0, class_counts)
+        results.append(prune_and_test(trained_tree, dataset[validation_rows], test_dataset, schema.classes, method))
+    return results
+
+# prunes a trained tree on a validation set and tests it on the test fold
+# input:
+#   - trained_tree: unpruned tree, with the class counts recorded by the builder
+#   - validation_set: rows used to decide prunes
+#   - test_dataset: test fold
+#   - classes: labels of the confusion matrix rows and columns
+#   - method: "reduced_error" (see prune_node), or "cost_complexity" to keep the subtree of the
+#     cost-complexity pruning path with the fewest validation errors (see cost_complexity_path)
+# returns depth before and after pruning, validation accuracy before pruning,
+# test accuracy after pruning, the confusion matrix of the pruned tree on the test fold
+# and the alpha of the pruned tree (None for reduced error pruning)
+def prune_and_test(trained_tree, validation_set, test_dataset, classes, method="reduced_error"):
+    if method not in PRUNING_METHODS:
+        raise ValueError(f"method must be one of {PRUNING_METHODS}, not {method!r}")
+    depth_before = depth(trained_tree)
+
+    # perform pruning, which also counts the validation rows the unpruned tree got right
+    with profile_stage("prune"):
+        if method == "reduced_error":
+            pruned_tree, _, correct_before = prune_subtree(trained_tree, validation_set) #prune the tree
+            alpha = None
+        else:
+            path = cost_complexity_path(trained_tree, validation_set, classes)
+            pruned_tree = path.tree()
+            correct_before = len(validation_set) - int(path.validation_errors[0])
+            alpha = path.best_alpha()
+    accuracy_before = correct_before / len(validation_set)
 
-            # update depth after pruning
-            depth_after += depth(pruned_tree)
+    # accuracy and confusion matrix of the pruned tree on the test fold, from one pass over it
+    with profile_stage("evaluate"):
+        cf = calculate_confusion_matrix(test_dataset, pruned_tree, classes)
+    accuracy_after = np.trace(cf) / len(test_dataset)
 
-            # update accuracies array
-            accuracy_after = evaluate_accuracy(pruned_tree, test_dataset)
-            accuracies_before.append(accuracy_before)
-            accuracies_after.append(accuracy_after)
+    return depth_before, depth(pruned_tree), accuracy_before, accuracy_after, cf, alpha
 
-            # compute confusion matrix for pruned tree
-            cf = calculate_confusion_matrix(test_dataset, pruned_tree)
-            confusion_matrices.append(cf)
+# nested 10-fold cross validation using pruning with decision trees
+# produces 90 trees overall
+# input:
+#   - dataset
+#   - workers: number of processes to run the folds on
+#   - presorted: sort each outer fold once and share it between its 9 inner trees,
+#     trees can differ from decision_tree_learning only where candidate splits tie
+#   - profile: collect counters and timers for each outer fold, see Profiler
+#   - summary: also return the mean and variance across the 90 trees of every metric, see fold_metrics
+#   - method: "reduced_error" or "cost_complexity", see prune_and_test
+#   - seed: seed of the folds, see fold_order
+#   - stratified: give every outer fold close to the same share of each class, the inner folds
+#     are then close to stratified too
+# returns the average confusion matrix, depth information and accuracy pre and post pruning,
+# followed by the fold metrics if summary (with the best alpha of every tree under "alpha" for
+# cost-complexity pruning) and the profiler report of each outer fold (its 9 inner trees together) if profile
+def prune(dataset, workers=1, presorted=False, profile=False, summary=False, method="reduced_error", seed=None,
+          stratified=False):
+
+    # folds are index arrays into the dataset, which is never shuffled or changed, see tenfold
+    dataset = read_only(dataset)
+    schema = DatasetSchema(dataset)
+    order = fold_order(len(dataset), 10, seed, schema.encode(dataset[:, -1]) if stratified else None)
 
+    # split the dataset into a train_and_validation set, and a test_dataset 10 times
+    # train each of these 9 times using train set and validation set to test / tune
+    if presorted:
+        outer_results = run_folds(prune_outer_fold, dataset, [(i, method) for i in range(10)], workers, profile,
+                                  (schema, order))
+        if profile:
+            reports = [dict(report, fold=i) for i, (_, report) in enumerate(outer_results)]
+            outer_results = [fold_results for fold_results, _ in outer_results]
+        results = [result for fold_results in outer_results for result in fold_results]
+    else:
+        folds = [(i, val_index, method) for i in range(10) for val_index in range(9)]
+        results = run_folds(prune_fold, dataset, folds, workers, profile, (schema, order))
+        if profile:
+            # combine the reports of the 9 inner trees of each outer fold
+            fold_profilers = [Profiler() for _ in range(10)]
+            for (i, _, _), (_, report) in zip(folds, results):
+                fold_profilers[i].merge(report)
+            reports = [dict(fold_profiler.report(), fold=i) for i, fold_profiler in enumerate(fold_profilers)]
+            results = [result for result, _ in results]
 
-    # compute average confusion matrix
-    summed_matrix = np.zeros((4,4))
-    for matrix in confusion_matrices:
-        for i in range(4):
-            summed_matrix[i] = [sum(x) for x in zip(summed_matrix[i], matrix[i])]
+    # variables to track, process and return
+    depth_before = sum(result[0] for result in results)
+    depth_after = sum(result[1] for result in results)
+    accuracies_before = [result[2] for result in results]
+    accuracies_after = [result[3] for result in results]
+    confusion_matrices = np.stack([result[4] for result in results])
 
     # compute average of metrics to return
-    average_cf = summed_matrix / len(confusion_matrices)
-    avg_depth_before_prune = depth_before / 90
-    avg_depth_after_prune = depth_after / 90
+    average_cf = confusion_matrices.sum(axis=0) / len(confusion_matrices)
+    avg_depth_before_prune = depth_before / len(results)
+    avg_depth_after_prune = depth_after / len(results)
     avg_accuracy_before = sum(accuracies_before) / len(accuracies_before)
     avg_accuracy_after = sum(accuracies_after) / len(accuracies_after)
 
-    return average_cf, avg_depth_before_prune, avg_depth_after_prune, avg_accuracy_before, avg_accuracy_after
+    returns = (average_cf, avg_depth_before_prune, avg_depth_after_prune, avg_accuracy_before, avg_accuracy_after)
+    if summary:
+        metrics = fold_metrics(confusion_matrices)
+        if method == "cost_complexity":
+            alphas = np.array([result[5] for result in results])
+            metrics["alpha"] = {"mean": alphas.mean(), "var": alphas.var(), "folds": alphas}
+        returns += (metrics,)
+    if profile:
+        returns += (reports,)
+    return returns
 
 
 
 
-# used by the prune function to actually prune a node and replace parent with label
+# pruning methods of prune_and_test and prune
+PRUNING_METHODS = ("reduced_error", "cost_complexity")
+
+
+# reduced error pruning, used by the prune function to replace subtrees with a leaf of their majority label
+# the validation set is routed down the tree once, and children are pruned before their parent, so every
+# node is compared against its already pruned subtree and a single pass reaches the fixpoint
+# a subtree is collapsed whenever that does not lower the number of validation rows it classifies correctly
 # input:
-#   - tree_node: initially root node, recursively becomes subtrees and leaf nodes
+#   - tree_node: root of the tree to prune, every node needs the class counts recorded by the builders
 #   - validation_set: to determine whether to prune or not
-#   - root_node: keep track of root note
-#   - leaf_map_count: label -> count
-#   - accuracy
-# returns pruned tree and its accuracy
-def prune_node(tree_node, validation_set, root_node, leaf_map_count, accuracy):
+# returns pruned tree and its accuracy on the validation set
+def prune_node(tree_node, validation_set):
+    tree_node, correct, _ = prune_subtree(tree_node, validation_set)
+    return tree_node, correct / len(validation_set)
+
 
-    #if its a leaf node, return the leaf and the
+# recursive step of prune_node
+# input:
+#   - tree_node: current subtree
+#   - rows: validation rows that reach tree_node
+# returns pruned subtree, the number of rows it classifies correctly, and the number the subtree
+# classified correctly before pruning
+def prune_subtree(tree_node, rows):
+    truth = rows[:, -1]
+
+    #if its a leaf node, return the leaf and the rows it gets right
     if tree_node.label != None:
-        return tree_node, accuracy
+        correct = int(np.sum(truth == tree_node.label))
+        return tree_node, correct, correct
 
     # prune both the left and right nodes
-    tree_node.left, accuracy = prune_node(tree_node.left, validation_set, root_node, leaf_map_count, accuracy)
-    tree_node.right, accuracy = prune_node(tree_node.right, validation_set, root_node, leaf_map_count, accuracy)
-
-    #if both the children are leafs, then prune
-    # store the current leaf values, in case we do not prune
-    if tree_node.left.label != None and tree_node.right.label != None:
-        left, right, feature, split_val = tree_node.left, tree_node.right, tree_node.feature, tree_node.split_val
-
-        #set the label of the parent to the majority class
-        if leaf_map_count[tree_node.left] >= leaf_map_count[tree_node.right]:
-            tree_node.label = tree_node.left.label
-        else:
-            tree_node.label = tree_node.right.label
-
-        # replacing node with empty one
-        leaf_map_count[tree_node] = leaf_map_count[tree_node.left] + leaf_map_count[tree_node.right]
-        tree_node.left = None
-        tree_node.right = None
-        tree_node.feature = None
-        tree_node.split_val = None
-        new_accuracy = evaluate_accuracy(root_node, validation_set)
-
-        #if after pruning, the accuracy was worse, resort back to original setting
-        if new_accuracy < accuracy:
-            tree_node.left = left
-            tree_node.right = right
-            tree_node.feature = feature
-            tree_node.split_val = split_val
-            tree_node.label = None
-            return tree_node, accuracy
-        return tree_node, min(accuracy, new_accuracy)
-
-    else:
-        return tree_node, accuracy
+    go_left = rows[:, tree_node.feature] <= tree_node.split_val
+    if profiler is not None:
+        profiler.count("rows_routed", len(rows))
+        profiler.count("prune_attempts")
+    tree_node.left, correct_left, before_left = prune_subtree(tree_node.left, rows[go_left])
+    tree_node.right, correct_right, before_right = prune_subtree(tree_node.right, rows[~go_left])
+
+    # the majority label of the training examples reaching this node
+    label = majority_label(tree_node.class_counts)
+    correct_leaf = int(np.sum(truth == label))
+
+    #if after pruning, the accuracy was worse, keep the subtree
+    if correct_leaf < correct_left + correct_right:
+        return tree_node, correct_left + correct_right, before_left + before_right
+
+    # replacing node with leaf
+    if profiler is not None:
+        profiler.count("prune_accepted")
+    tree_node.label = label
+    tree_node.left = None
+    tree_node.right = None
+    tree_node.feature = None
+    tree_node.split_val = None
+    return tree_node, correct_leaf, before_left + before_right
+
+
+# cost-complexity (weakest link) pruning path of a trained tree, see cost_complexity_path
+# the path is the sequence of nested subtrees that are optimal for increasing alpha, where a subtree
+# costs its training error rate plus alpha per leaf. Subtree 0 is the unpruned tree and every later one
+# collapses the subtrees whose error per removed leaf is smallest, down to the root alone
+# each path stores:
+#   1. nodes: the nodes of the tree in pre-order, node ids index every per node array
+#   2. parents: id of the parent of each node, -1 for the root
+#   3. router: FlatTree of the unpruned tree, routes rows to the node they end at
+#   4. classes: sorted labels of the confusion matrices
+#   5. predicted: class id a node predicts as a leaf, the majority of its training examples
+#   6. alphas: alpha at which each subtree of the sequence becomes optimal, non decreasing
+#   7. n_leaves: number of leaves of each subtree
+#   8. train_errors: number of training examples each subtree misclassifies
+#   9. first, last: node k is a leaf of subtrees first[k] to last[k] - 1, of none if first[k] >= last[k]
+#   10. validation_errors: validation rows each subtree misclassifies, if built with a validation set
+class PruningPath:
+    def __init__(self, nodes, parents, router, classes, predicted, alphas, n_leaves, train_errors, first, last):
+        self.nodes = nodes
+        self.parents = parents
+        self.router = router
+        self.classes = classes
+        self.predicted = predicted
+        self.alphas = alphas
+        self.n_leaves = n_leaves
+        self.train_errors = train_errors
+        self.first = first
+        self.last = last
+        self.validation_errors = None
+
+    # confusion matrix of every subtree of the path on a dataset, from a single pass over it
+    # the rows of each class are routed down the unpruned tree once, and the node hits of that traversal
+    # count the rows of the class reaching every node. A node then adds its counts to the column of its
+    # predicted class in every subtree it is a leaf of
+    # input:
+    #   - dataset: rows with the label as the last column
+    # returns (subtrees x classes x classes) confusion matrices, rows are true and columns predicted labels
+    def confusion_matrices(self, dataset):
+        n_classes = len(self.classes)
+        truth = np.searchsorted(self.classes, dataset[:, -1].astype(int))
+        by_class = np.argsort(truth, kind='stable')
+        bounds = np.searchsorted(truth[by_class], np.arange(n_classes + 1))
+        counts = np.stack([self.router.traverse(dataset[by_class[bounds[c]:bounds[c+1]]])[1]
+                           for c in range(n_classes)], axis=1)
+
+        # each node adds its counts to the subtrees it is a leaf of, through a difference array over subtree ids
+        leaf = self.first < self.last
+        first, last, predicted = self.first[leaf], self.last[leaf], self.predicted[leaf]
+        changes = np.zeros((len(self.alphas) + 1, n_classes, n_classes), dtype=np.int64)
+        np.add.at(changes, (first, slice(None), predicted), counts[leaf])
+        np.subtract.at(changes, (last, slice(None), predicted), counts[leaf])
+        return np.cumsum(changes[:-1], axis=0)
+
+    # number of rows of a dataset each subtree of the path misclassifies, see confusion_matrices
+    def errors(self, dataset):
+        confusion_matrices = self.confusion_matrices(dataset)
+        return len(dataset) - np.trace(confusion_matrices, axis1=1, axis2=2)
+
+    # index of the subtree with the fewest validation errors, ties go to the smaller subtree
+    def best(self):
+        return len(self.validation_errors) - 1 - int(np.argmin(self.validation_errors[::-1]))
+
+    # alpha of the subtree with the fewest validation errors
+    def best_alpha(self):
+        return float(self.alphas[self.best()])
+
+    # index of the subtree that is optimal for an alpha
+    def index(self, alpha):
+        return max(int(np.searchsorted(self.alphas, alpha, side='right')) - 1, 0)
+
+    # a subtree of the path as a new Node tree, the tree the path was computed from is left unchanged
+    # input:
+    #   - index: id of the subtree in the sequence, the best subtree on the validation set by default
+    # returns the root node of the subtree
+    def tree(self, index=None):
+        if index is None:
+            index = self.best()
+
+        def copy_node(k):
+            node = self.nodes[k]
+            if self.first[k] <= index:
+                label = int(self.classes[self.predicted[k]])
+                return Node(None, None, node.depth, label=label, class_counts=node.class_counts)
+            return Node(node.feature, node.split_val, node.depth, class_counts=node.class_counts,
+                        left=copy_node(self.router.left[k]), right=copy_node(self.router.right[k]))
+        return copy_node(0)
+
+
+# computes the whole cost-complexity pruning path of a trained tree in one pass (Breiman et al., CART)
+# every internal node t has a critical value g(t) = (R(t) - R(T_t)) / (leaves of T_t - 1), the training error
+# rate it would add per leaf removed by collapsing it. The node with the smallest g is collapsed and only
+# its ancestors are updated, through a heap of g values, so the path costs O(nodes x depth) and no
+# candidate tree is ever built or evaluated on its own
+# the validation errors of all subtrees come from a single pass over the validation set, see confusion_matrices
+# input:
+#   - tree: root of the trained tree, every node needs the class counts recorded by the builders
+#   - validation_set: rows to score every subtree on, needed for best and best_alpha
+#   - classes: sorted labels, by default the labels of the training examples and the validation set
+# returns the PruningPath
+def cost_complexity_path(tree, validation_set=None, classes=None):
+    # nodes in pre-order, with the same numbering as compile_tree
+    nodes, parents, lefts, rights = [], [], [], []
+    stack = [(tree, -1, True)]
+    while stack:
+        node, parent, is_left = stack.pop()
+        node_id = len(nodes)
+        if parent >= 0:
+            if is_left:
+                lefts[parent] = node_id
+            else:
+                rights[parent] = node_id
+        nodes.append(node)
+        parents.append(parent)
+        lefts.append(-1)
+        rights.append(-1)
+        if node.label == None:
+            stack.append((node.right, node_id, False))
+            stack.append((node.left, node_id, True))
+
+    if classes is None:
+        classes = np.array(sorted(tree.class_counts))
+        if validation_set is not None:
+            classes = np.union1d(classes, validation_set[:, -1].astype(int))
+    classes = np.asarray(classes)
+
+    # training error of each node as a leaf, and the class id it would predict
+    n_nodes = len(nodes)
+    is_leaf = [node.label != None for node in nodes]
+    leaf_labels = [node.label if node.label != None else majority_label(node.class_counts) for node in nodes]
+    predicted = np.searchsorted(classes, leaf_labels)
+    leaf_errors = [sum(node.class_counts.values()) - node.class_counts.get(label, 0)
+                   for node, label in zip(nodes, leaf_labels)]
+
+    # training errors and leaves of every subtree, children come after their parent in pre-order
+    subtree_errors = [errors if leaf else 0 for errors, leaf in zip(leaf_errors, is_leaf)]
+    subtree_leaves = [int(leaf) for leaf in is_leaf]
+    sizes = [1] * n_nodes
+    for k in range(n_nodes - 1, 0, -1):
+        subtree_errors[parents[k]] += subtree_errors[k]
+        subtree_leaves[parents[k]] += subtree_leaves[k]
+        sizes[parents[k]] += sizes[k]
+
+    # weakest link pruning, heap entries are (g, node id, version), entries of an older version are stale
+    n_train = sum(tree.class_counts.values())
+    def critical_value(k):
+        return (leaf_errors[k] - subtree_errors[k]) / (n_train * (subtree_leaves[k] - 1))
+
+    version = [0] * n_nodes
+    alive = np.ones(n_nodes, dtype=bool)
+    queue = [(critical_value(k), k, 0) for k in range(n_nodes) if not is_leaf[k]]
+    heapq.heapify(queue)
+
+    first = np.where(is_leaf, 0, n_nodes + 1)
+    alphas, n_leaves, train_errors = [0.0], [subtree_leaves[0]], [subtree_errors[0]]
+    while queue:
+        g, k, node_version = heapq.heappop(queue)
+        if node_version != version[k] or not alive[k]:
+            continue
+        if profiler is not None:
+            profiler.count("prune_accepted")
+
+        # subtrees collapsed at the same alpha belong to one subtree of the sequence
+        g = max(g, alphas[-1])
+        if g > alphas[-1] or len(alphas) == 1:
+            alphas.append(g)
+            n_leaves.append(n_leaves[-1])
+            train_errors.append(train_errors[-1])
+        first[k] = len(alphas) - 1
+        alive[k + 1: k + sizes[k]] = False
+
+        # collapse k and update its ancestors
+        removed_leaves = subtree_leaves[k] - 1
+        added_errors = leaf_errors[k] - subtree_errors[k]
+        n_leaves[-1] -= removed_leaves
+        train_errors[-1] += added_errors
+        subtree_leaves[k], subtree_errors[k] = 1, leaf_errors[k]
+        parent = parents[k]
+        while parent >= 0:
+            subtree_leaves[parent] -= removed_leaves
+            subtree_errors[parent] += added_errors
+            version[parent] += 1
+            heapq.heappush(queue, (critical_value(parent), parent, version[parent]))
+            parent = parents[parent]
+
+    # a node stops being a leaf when one of its ancestors is collapsed
+    first = np.minimum(first, len(alphas))
+    last = np.full(n_nodes, len(alphas))
+    for k in range(1, n_nodes):
+        last[k] = min(last[parents[k]], first[parents[k]])
+
+    path = PruningPath(nodes, parents, compile_tree(tree), classes, predicted, np.array(alphas), np.array(n_leaves),
+                       np.array(train_errors), first, last)
+    if validation_set is not None:
+        path.validation_errors = path.errors(validation_set)
+    return path
 
 # helper function for tabulating data for report
 # tabulate the accuracy and depth stats for pruned tree
-#   - f1_measures: f1 measure for each class
+#   - report: ReportWriter to write the table to as a PNG file instead of showing it
 # returns nothing but displays table when called
-def display_info_table(dataset_name, cf_matrix, avg_before, avg_after, avg_acc_before, avg_acc_after):
-    true_values = sum(cf_matrix[i][i] for i in range(4))
+def display_info_table(dataset_name, cf_matrix, avg_before, avg_after, avg_acc_before, avg_acc_after, report=None):
+    true_values = np.trace(cf_matrix)
     accuracy = true_values / cf_matrix.sum()
     accuracy = round(accuracy, 3)
     avg_acc_after = round(avg_acc_after, 3)
@@ -602,7 +2877,7 @@ def display_info_table(dataset_name, cf_matrix, avg_before, avg_after, avg_acc_b
     print("Avg Accuracy Before Pruning: ", avg_acc_before)
     print("Avg Accuracy After Pruning: ", avg_acc_after)
     print("Avg Improvement in Accuracy %: ", avg_improvement)
-    fig, ax = plt.subplots()
+    fig, ax = report_figure(report)
     ax.axis('off')
     ax.axis('tight')
 
@@ -625,24 +2900,209 @@ def display_info_table(dataset_name, cf_matrix, avg_before, avg_after, avg_acc_b
     table.set_fontsize(10)
     table.scale(1, 1.5)
 
-    plt.title(dataset_name)
-    plt.show()
+    ax.set_title(dataset_name)
+    finish_figure(report, report_name(dataset_name), fig)
 
     return accuracy
 
+# builders the benchmarks can time, by name
+BENCHMARK_BUILDERS = {
+    "exact": lambda dataset: decision_tree_learning(dataset, 0),
+    "presorted": decision_tree_learning_presorted,
+    "histogram": decision_tree_learning_histogram,
+    "iterative": decision_tree_learning_iterative,
+}
+
+# synthetic dataset sizes the benchmarks run on, as (rows, features, classes)
+BENCHMARK_CONFIGS = [
+    (1_000, 7, 4),
+    (10_000, 7, 4),
+    (100_000, 7, 4),
+    (1_000_000, 7, 4),
+    (10_000_000, 7, 4),
+    (10_000, 50, 20),
+    (10_000, 500, 200),
+    (100_000, 100, 50),
+]
+
+
+# generates a synthetic dataset that looks like the WiFi RSSI data: each room has a mean signal
+# strength per access point, samples are integer dBm readings scattered around it
+# input:
+#   - n_rows, n_features, n_classes: size of the dataset, labels are 1..n_classes
+#   - noise: fraction of rows given a random label
+#   - seed: seed of the random generator, the same seed gives the same dataset
+# returns the dataset, label in the last column
+def synthetic_rssi_dataset(n_rows, n_features, n_classes, noise=0.1, seed=0):
+    rng = np.random.default_rng(seed)
+    room_means = rng.uniform(-90, -30, size=(n_classes, n_features))
+    labels = rng.integers(0, n_classes, size=n_rows)
+
+    dataset = np.empty((n_rows, n_features + 1))
+    dataset[:, :-1] = np.clip(np.round(room_means[labels] + rng.normal(0, 4, size=(n_rows, n_features))), -100, 0)
+
+    noisy = rng.random(n_rows) < noise
+    labels[noisy] = rng.integers(0, n_classes, size=noisy.sum())
+    dataset[:, -1] = labels + 1
+    return dataset
+
+
+# times one benchmark stage, and optionally measures its peak memory in a second, traced run
+# (tracemalloc slows the code it traces, so it never runs during the timed run)
+# input:
+#   - function: stage to run, called with args
+#   - measure_memory: whether to also record the peak memory allocated by the stage
+# returns the result of the timed run, wall clock seconds and peak bytes (None if not measured)
+def time_stage(function, *args, measure_memory=True):
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+
+    peak = None
+    if measure_memory:
+        import tracemalloc
+        tracemalloc.start()
+        function(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+# benchmarks training, prediction, pruning and cross validation on one dataset
+# the rows are put in a fixed stratified random order (wifi_db is sorted by class), then the first 80% are used
+# for training, the next 10% for pruning and the last 10% for testing
+# input:
+#   - name: name of the dataset in the results
+#   - dataset
+#   - builders: names of BENCHMARK_BUILDERS to time
+#   - measure_memory: whether to record peak memory of each stage
+#   - cv_max_rows: tenfold cross validation is only timed on datasets up to this many rows
+# returns a list of records, one per stage
+def benchmark_dataset(name, dataset, builders, measure_memory=True, cv_max_rows=20_000):
+    bounds = fold_bounds(len(dataset), 10)
+    order = fold_order(len(dataset), 10, 0, dataset[:, -1])
+    train, validation_set, test = (dataset[order[:bounds[8]]], dataset[order[bounds[8]:bounds[9]]],
+                                   dataset[order[bounds[9]:]])
+    info = {"dataset": name, "rows": len(dataset), "features": dataset.shape[1] - 1,
+            "classes": len(np.unique(dataset[:, -1]))}
+    records = []
+
+    def record(builder, stage, seconds, peak, **extra):
+        records.append({**info, "builder": builder, "stage": stage, "seconds": seconds, "peak_bytes": peak, **extra})
+        print(f"{name:>24} {builder:>10} {stage:>10} {seconds:10.4f}s")
+
+    for builder in builders:
+        tree, seconds, peak = time_stage(BENCHMARK_BUILDERS[builder], train, measure_memory=measure_memory)
+        record(builder, "train", seconds, peak, depth=depth(tree))
+
+        flat, seconds, peak = time_stage(compile_tree, tree, measure_memory=measure_memory)
+        record(builder, "compile", seconds, peak, nodes=len(flat.feature))
+
+        # the first traversal compiles the numba kernel, which is kept out of the predict time
+        flat.predict_batch(dataset[:1])
+        predictions, seconds, peak = time_stage(flat.predict_batch, dataset, measure_memory=measure_memory)
+        record(builder, "predict", seconds, peak, rows_per_second=len(dataset) / seconds)
+
+        # pruning changes the tree in place, so it is timed last and traced on a copy of the tree
+        tree_copy = copy.deepcopy(tree) if measure_memory else None
+        (pruned, accuracy), seconds, _ = time_stage(prune_node, tree, validation_set, measure_memory=False)
+        peak = time_stage(prune_node, tree_copy, validation_set)[2] if measure_memory else None
+        record(builder, "prune", seconds, peak, depth=depth(pruned), test_accuracy=evaluate_accuracy(pruned, test))
+
+    if len(dataset) <= cv_max_rows:
+        (_, accuracy), seconds, peak = time_stage(tenfold, dataset, measure_memory=measure_memory)
+        record("exact", "tenfold", seconds, peak, accuracy=accuracy)
+    return records
+
+
+# runs the benchmark suite and writes the results to a JSON file, to compare across commits
+# the bundled wifi_db datasets are always benchmarked first as a fixed baseline
+# input:
+#   - configs: synthetic dataset sizes as (rows, features, classes), see BENCHMARK_CONFIGS
+#   - builders: names of BENCHMARK_BUILDERS to time
+#   - output_path: JSON file the results are written to
+#   - measure_memory: whether to record peak memory of each stage
+#   - cv_max_rows: tenfold cross validation is only timed on datasets up to this many rows
+# returns the list of result records
+def run_benchmarks(configs=BENCHMARK_CONFIGS, builders=("exact", "presorted", "histogram"),
+                   output_path="benchmark_results.json", measure_memory=True, cv_max_rows=20_000):
+    records = []
+    for name, path in (("wifi_db/clean", CLEAN_DATASET_PATH), ("wifi_db/noisy", NOISY_DATASET_PATH)):
+        dataset = np.array(load_dataset(path))
+        records += benchmark_dataset(name, dataset, builders, measure_memory, cv_max_rows)
+
+    for n_rows, n_features, n_classes in configs:
+        dataset = synthetic_rssi_dataset(n_rows, n_features, n_classes)
+        records += benchmark_dataset(f"synthetic_{n_rows}x{n_features}x{n_classes}", dataset,
+                                     builders, measure_memory, cv_max_rows)
+
+    import platform
+    import subprocess
+
+    # commit the results were measured at, if this is a git checkout
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    with open(output_path, "w") as f:
+        json.dump({"commit": commit, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                   "numpy": np.__version__, "machine": platform.machine(), "results": records},
+                  f, indent=2, default=float)
+    return records
+
+# run the quick part of the suite (small synthetic sizes), or everything with run_benchmarks()
+# run_benchmarks(BENCHMARK_CONFIGS[:2])
+
 ## remaining code gets the figures and metrics/stats needed for the report
 ## can replace with own dataset to set
 
-# cf_matrix_clean, avg_before_clean, avg_after_clean, avg_acc_before_clean, avg_acc_after_clean = prune(clean_dataset)
-
-# clean_prune_accuracy = display_info_table("Clean Dataset", cf_matrix_clean, avg_before_clean, avg_after_clean, avg_acc_before_clean, avg_acc_after_clean)
-# displayCF(cf_matrix_clean)
-# accuracy_clean, precisions_clean, recalls_clean, f1_measures_clean = compute_metrics_cf(cf_matrix_clean)
-# display_metrics_table("Clean Pruned", accuracy_clean, precisions_clean, recalls_clean, f1_measures_clean)
-
-cf_matrix_noisy, avg_before_noisy, avg_after_noisy, avg_acc_before_noisy, avg_acc_after_noisy = prune(noisy_dataset)
-
-noisy_prune_accuracy = display_info_table("Noisy Dataset", cf_matrix_noisy, avg_before_noisy, avg_after_noisy, avg_acc_before_noisy, avg_acc_after_noisy)
-displayCF(cf_matrix_noisy)
-accuracy_noisy, precisions_noisy, recalls_noisy, f1_measures_noisy = compute_metrics_cf(cf_matrix_noisy)
-display_metrics_table("Noisy Pruned", accuracy_noisy, precisions_noisy, recalls_noisy, f1_measures_noisy)
\ No newline at end of file
+# runs nested cross validation with pruning on each dataset and reports the results
+# by default the tables and confusion matrices are written as PNG files, with every number in a JSON file,
+# to the report directory in the background, so it runs on headless machines; --show displays them instead
+# input:
+#   - argv: command line arguments, sys.argv by default
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Decision tree learning with reduced error pruning")
+    parser.add_argument("datasets", nargs="*", default=["noisy"],
+                        help="datasets to evaluate: clean, noisy or a path to a dataset file (default: noisy)")
+    parser.add_argument("--report-dir", default="reports", help="directory the report files are written to")
+    parser.add_argument("--show", action="store_true", help="show the figures instead of writing them")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes to run the folds on")
+    parser.add_argument("--presorted", action="store_true", help="presort each outer fold, see prune")
+    parser.add_argument("--method", choices=PRUNING_METHODS, default="reduced_error", help="pruning method")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the folds, random by default")
+    parser.add_argument("--stratified", action="store_true", help="stratify the folds by class")
+    args = parser.parse_args(argv)
+
+    report = None if args.show else ReportWriter(args.report_dir)
+    try:
+        for name in args.datasets:
+            path = {"clean": CLEAN_DATASET_PATH, "noisy": NOISY_DATASET_PATH}.get(name, name)
+            title = os.path.splitext(os.path.basename(path))[0].replace("_", " ").title()
+            dataset = load_dataset(path)
+            labels = DatasetSchema(dataset).classes
+
+            cf_matrix, avg_before, avg_after, avg_acc_before, avg_acc_after, summary = prune(
+                dataset, workers=args.workers, presorted=args.presorted, summary=True, method=args.method, seed=args.seed,
+                stratified=args.stratified)
+
+            display_info_table(title, cf_matrix, avg_before, avg_after, avg_acc_before, avg_acc_after, report=report)
+            displayCF(cf_matrix, labels, report=report, name=f"{title} Confusion Matrix")
+            accuracy, precisions, recalls, f1_measures = compute_metrics_cf(cf_matrix)
+            display_metrics_table(f"{title} Pruned", accuracy, precisions, recalls, f1_measures, labels, report=report)
+
+            if report is not None:
+                report.save_json(report_name(title), {
+                    "dataset": path, "labels": labels, "confusion_matrix": cf_matrix,
+                    "average_depth_before": avg_before, "average_depth_after": avg_after,
+                    "average_accuracy_before": avg_acc_before, "average_accuracy_after": avg_acc_after,
+                    "metrics": confusion_metrics(cf_matrix), "fold_metrics": summary})
+    finally:
+        if report is not None:
+            report.close()
+
+
+if __name__ == "__main__":
+    main()
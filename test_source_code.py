@@ -0,0 +1,426 @@
+# checks source_code against the original code and by hand on the wifi_db datasets
+# run with `python -m pytest -q` or `python test_source_code.py`
+
+import asyncio
+import copy
+import json
+import os
+import tempfile
+from unittest import mock
+
+import numpy as np
+import pytest
+
+import source_code as sc
+
+
+# the original recursive builder, kept as it was before the split search was vectorized
+def reference_decision_tree_learning(dataset, depth):
+    dataset_map = {}
+    total_count = len(dataset)
+    for i in dataset:
+        dataset_map[int(i[-1])] = dataset_map.get(int(i[-1]), 0) + 1
+
+    if len(dataset_map) == 1:
+        return sc.Node(None, None, depth=depth, label=next(iter(dataset_map)))
+
+    minEntropy = float("inf")
+    minEntropy_feature = 0
+    minEntropySplit = 0
+    minEntropyidx = 0
+    for feature in range(dataset.shape[1] - 1):
+        dataset = dataset[np.apply_along_axis(lambda x: x[feature], 1, dataset).argsort()]
+        left = {}
+        idx = 0
+        val = dataset[idx][feature]
+        while idx < len(dataset):
+            while idx < len(dataset) and dataset[idx][feature] == val:
+                left[dataset[idx][-1]] = left.get(dataset[idx][-1], 0) + 1
+                idx += 1
+            entropy = sc.computeEntropy(left, dataset_map, idx, total_count)
+            if entropy < minEntropy:
+                minEntropy = entropy
+                minEntropy_feature = feature
+                minEntropySplit = val
+                minEntropyidx = idx
+            if idx < len(dataset):
+                val = dataset[idx][feature]
+
+    dataset = dataset[np.apply_along_axis(lambda x: x[minEntropy_feature], 1, dataset).argsort()]
+    ret = sc.Node(minEntropy_feature, minEntropySplit, depth=depth)
+    ret.left = reference_decision_tree_learning(dataset[:minEntropyidx], depth + 1)
+    ret.right = reference_decision_tree_learning(dataset[minEntropyidx:], depth + 1)
+    return ret
+
+
+# reduced error pruning by re-classifying the whole validation set for every candidate collapse
+def reference_prune(tree_node, root, validation_set):
+    if tree_node.label != None:
+        return
+    reference_prune(tree_node.left, root, validation_set)
+    reference_prune(tree_node.right, root, validation_set)
+
+    accuracy = sc.evaluate_accuracy(root, validation_set)
+    saved = tree_node.left, tree_node.right, tree_node.feature, tree_node.split_val
+    tree_node.label = sc.majority_label(tree_node.class_counts)
+    tree_node.left = tree_node.right = tree_node.feature = tree_node.split_val = None
+    if sc.evaluate_accuracy(root, validation_set) < accuracy:
+        tree_node.left, tree_node.right, tree_node.feature, tree_node.split_val = saved
+        tree_node.label = None
+
+
+def datasets():
+    return [np.array(sc.clean_dataset), np.array(sc.noisy_dataset)]
+
+
+# first node where two trees differ, as (path from the root, node of a, node of b), or None if they are the same
+def first_difference(a, b, path=""):
+    if a.label != None or b.label != None:
+        return None if a.label == b.label else (path, a, b)
+    if a.feature != b.feature or a.split_val != b.split_val:
+        return path, a, b
+    return first_difference(a.left, b.left, path + "L") or first_difference(a.right, b.right, path + "R")
+
+
+def test_exact_builder_matches_original():
+    for dataset in datasets():
+        reference = reference_decision_tree_learning(dataset.copy(), 0)
+        assert first_difference(reference, sc.decision_tree_learning(dataset.copy(), 0)) is None
+
+
+
+# every node where two trees differ, without descending below a difference
+def differences(a, b, path=""):
+    if a.label != None or b.label != None or a.feature != b.feature or a.split_val != b.split_val:
+        return [] if first_difference(a, b) is None else [(path, a, b)]
+    return differences(a.left, b.left, path + "L") + differences(a.right, b.right, path + "R")
+
+
+# rows of a dataset that reach the node at a path from the root
+def rows_at(tree, dataset, path):
+    for step in path:
+        go_left = dataset[:, tree.feature] <= tree.split_val
+        dataset, tree = (dataset[go_left], tree.left) if step == "L" else (dataset[~go_left], tree.right)
+    return dataset
+
+
+def split_entropy(rows, feature, split_val):
+    classes, labels = np.unique(rows[:, -1], return_inverse=True)
+    go_left = rows[:, feature] <= split_val
+    entropy = 0.0
+    for side in (labels[go_left], labels[~go_left]):
+        counts = np.bincount(side, minlength=len(classes))
+        p = counts[counts > 0] / len(side)
+        entropy -= len(side) / len(rows) * np.sum(p * np.log2(p))
+    return entropy
+
+
+# a builder may only choose a different split than decision_tree_learning where the two have the same entropy
+def assert_differs_only_at_tied_splits(builder):
+    for dataset in datasets():
+        reference = sc.decision_tree_learning(dataset.copy(), 0)
+        for path, a, b in differences(reference, builder(dataset)):
+            rows = rows_at(reference, dataset, path)
+            assert a.label == None and b.label == None
+            assert np.isclose(split_entropy(rows, a.feature, a.split_val),
+                              split_entropy(rows, b.feature, b.split_val), rtol=0, atol=1e-12)
+
+
+def test_presorted_builder_differs_only_at_tied_splits():
+    assert_differs_only_at_tied_splits(sc.decision_tree_learning_presorted)
+
+
+
+def test_iterative_builder_differs_only_at_tied_splits():
+    assert_differs_only_at_tied_splits(sc.decision_tree_learning_iterative)
+
+
+def test_histogram_builder_differs_only_at_tied_splits():
+    assert_differs_only_at_tied_splits(sc.decision_tree_learning_histogram)
+
+
+def test_more_than_256_bins_are_rejected():
+    dataset = np.column_stack([np.arange(300.0), np.arange(300) % 2])
+    for learn in (sc.decision_tree_learning_histogram, sc.decision_tree_learning_streaming,
+                  sc.incremental_tree_learning):
+        with pytest.raises(ValueError):
+            learn(dataset, max_bins=300)
+    with pytest.raises(ValueError):
+        sc.bin_codes(dataset, [np.arange(300.0)])
+
+
+def test_prune_node_matches_whole_tree_reevaluation():
+    for dataset in datasets():
+        tree = sc.decision_tree_learning(dataset[::2].copy(), 0)
+        validation_set = dataset[1::2]
+        reference = copy.deepcopy(tree)
+        reference_prune(reference, reference, validation_set)
+        pruned, accuracy = sc.prune_node(tree, validation_set)
+        assert first_difference(reference, pruned) is None
+        assert accuracy == sc.evaluate_accuracy(reference, validation_set)
+
+
+def test_parallel_folds_match_serial_folds():
+    dataset = np.array(sc.noisy_dataset)[::8]
+    for run in (sc.tenfold, sc.prune):
+        serial, parallel = run(dataset, workers=1, seed=0), run(dataset, workers=2, seed=0)
+        for a, b in zip(serial, parallel):
+            assert np.array_equal(a, b)
+
+
+
+def test_load_dataset_cache_is_readable_by_others_and_optional():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "dataset.txt")
+        with open(path, "w") as f:
+            f.write("-64 -56 1\n-68 -57 2\n")
+        expected = np.array([[-64, -56, 1], [-68, -57, 2]], dtype=float)
+        assert np.array_equal(sc.load_dataset(path), expected)
+        umask = os.umask(0)
+        os.umask(umask)
+        assert os.stat(path + ".npy").st_mode & 0o777 == 0o666 & ~umask
+
+        # a cache that cannot be read, e.g. one written by another user, falls back to parsing the text
+        with mock.patch.object(np, "load", side_effect=PermissionError):
+            assert np.array_equal(sc.load_dataset(path), expected)
+
+        empty = os.path.join(directory, "empty.txt")
+        open(empty, "w").close()
+        for cache in (True, False):
+            with pytest.raises(ValueError):
+                sc.load_dataset(empty, cache=cache)
+        assert sorted(os.listdir(directory)) == ["dataset.txt", "dataset.txt.npy", "empty.txt"]
+
+
+def test_saved_tree_loads_read_only_with_the_same_predictions():
+    dataset = np.array(sc.noisy_dataset)
+    flat = sc.compile_tree(sc.decision_tree_learning(dataset.copy(), 0))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "tree.bin")
+        sc.save_tree(flat, path)
+        loaded = sc.load_tree(path)
+        assert np.array_equal(loaded.predict_batch(dataset), flat.predict_batch(dataset))
+        for array in (loaded.feature, loaded.threshold, loaded.left, loaded.right, loaded.label):
+            assert not array.flags.writeable
+        with open(path, "rb") as f:
+            data = f.read()
+        del loaded, array
+
+        # wrong magic, a version from the future and a file cut short are all refused
+        version = sc.TREE_FILE_HEADER.fields["version"][1]
+        for bad in (b"NOTATREE" + data[8:], data[:version] + b"\xff" + data[version + 1:], data[:-1]):
+            with open(path, "wb") as f:
+                f.write(bad)
+            with pytest.raises(ValueError):
+                sc.load_tree(path)
+
+
+def test_prediction_server_answers_pipelined_rows_in_order():
+    dataset = np.array(sc.noisy_dataset)[:300]
+    tree = sc.decision_tree_learning(dataset.copy(), 0)
+    server = sc.PredictionServer(tree, batch_window=0.01, max_batch=64)
+
+    async def session(path):
+        serving = asyncio.create_task(server.serve(path=path))
+        while not os.path.exists(path):
+            await asyncio.sleep(0.001)
+        reader, writer = await asyncio.open_unix_connection(path)
+        answers = []
+        for lines in ([" ".join(str(value) for value in row) for row in dataset] + ["-60 x"], ["stats"]):
+            writer.write(("\n".join(lines) + "\n").encode())
+            await writer.drain()
+            answers += [(await reader.readline()).decode().strip() for _ in lines]
+        writer.close()
+        serving.cancel()
+        return answers
+
+    with tempfile.TemporaryDirectory() as directory:
+        answers = asyncio.run(session(os.path.join(directory, "server.sock")))
+    assert [int(answer) for answer in answers[:-2]] == [sc.compute_class(row, tree) for row in dataset]
+    assert answers[-2].startswith("error")
+    stats = json.loads(answers[-1])
+    assert stats["requests"] == len(dataset) and stats["errors"] == 1
+    assert stats["batches"] < len(dataset)
+
+
+def split_gini(rows, feature, split_val):
+    go_left = rows[:, feature] <= split_val
+    gini = 0.0
+    for side in (rows[go_left, -1], rows[~go_left, -1]):
+        p = np.unique(side, return_counts=True)[1] / len(side)
+        gini += len(side) / len(rows) * (1 - np.sum(p * p))
+    return gini
+
+
+def test_criteria_match_their_formulas():
+    rng = np.random.default_rng(0)
+    class_counts = np.array([70, 0, 80000, 30])
+    left_counts = np.minimum(rng.integers(0, 80000, size=(50, 4)), class_counts)
+    count_left = left_counts.sum(axis=1)
+    n = class_counts.sum()
+    for name, impurity in (("entropy", lambda c: -np.sum(c[c > 0] / c.sum() * np.log2(c[c > 0] / c.sum()))),
+                           ("gini", lambda c: 1 - np.sum((c / c.sum()) ** 2))):
+        expected = [(k * impurity(left) if k else 0) + (n - k) * impurity(class_counts - left)
+                    for left, k in zip(left_counts, count_left)]
+        criterion = sc.get_criterion(name)
+        assert np.allclose(criterion.split_impurities(left_counts, count_left, class_counts, n), np.array(expected) / n)
+        assert np.isclose(criterion.impurity(class_counts), impurity(class_counts))
+
+
+def test_gini_builders_choose_the_best_gini_split():
+    for dataset in datasets():
+        best = min(split_gini(dataset, feature, value)
+                   for feature in range(dataset.shape[1] - 1) for value in np.unique(dataset[:, feature])[:-1])
+        for builder in (sc.decision_tree_learning_presorted, sc.decision_tree_learning_iterative,
+                        sc.decision_tree_learning_histogram):
+            root = builder(dataset, criterion="gini")
+            assert np.isclose(split_gini(dataset, root.feature, root.split_val), best, rtol=0, atol=1e-12)
+
+
+def test_streaming_builder_matches_histogram():
+    for dataset in datasets():
+        streamed = sc.decision_tree_learning_streaming(dataset, chunk_bytes=300 * dataset[0].nbytes,
+                                                       max_histogram_bytes=1 << 14)
+        assert first_difference(streamed, sc.decision_tree_learning_histogram(dataset)) is None
+
+
+def test_stream_bins_only_sample_features_with_many_values():
+    rng = np.random.default_rng(0)
+    # the second feature only gets more than 16 distinct values in its last chunks, so the rows counted before
+    # have to be sampled too
+    late = np.concatenate([rng.integers(0, 10, 15000), rng.uniform(0, 10, 5000)])
+    dataset = np.column_stack([rng.integers(-90, -30, 20000), late, rng.integers(0, 3, 20000)]).astype(float)
+    classes, bin_values, n_rows = sc.stream_bins(dataset, chunk_bytes=1000 * dataset[0].nbytes, max_bins=16,
+                                                 sample_bytes=1 << 14)
+    assert n_rows == len(dataset) and classes.tolist() == [0, 1, 2]
+    for column, edges in zip(dataset[:, :-1].T, bin_values):
+        assert len(edges) <= 16 and edges[-1] == column.max()
+
+        # every bin holds close to 1/16 of the rows, the sample takes 512 values per feature
+        shares = np.bincount(np.searchsorted(edges, column), minlength=len(edges)) / len(column)
+        assert shares.max() < 2.5 / 16
+
+
+def tree_nodes(node):
+    return [node] if node.label != None else [node] + tree_nodes(node.left) + tree_nodes(node.right)
+
+
+def test_values_past_the_edges_fall_in_the_outer_bins():
+    for column in (np.linspace(0, 1, 256), np.arange(256.0) - 300):
+        _, bin_values = sc.bin_dataset(np.column_stack([column, np.zeros(256)]))
+        assert len(bin_values[0]) == 256
+        assert sc.bin_codes(np.array([[5.0, 1], [-500.0, 1]]), bin_values)[:, 0].tolist() == [255, 0]
+
+
+def test_incremental_tree_counts_every_row_once():
+    dataset = np.array(sc.clean_dataset)[sc.fold_order(2000, 10, 0)]
+    for batch_tree, first in ((False, 10), (True, 200)):
+        tree = sc.incremental_tree_learning(dataset[:first], classes=[1, 2, 3, 4], batch_tree=batch_tree,
+                                            grace_period=50, delta=1e-3)
+        for start in range(first, len(dataset), 100):
+            tree.update(dataset[start:start + 100])
+
+        # the root counts every row seen, and every split node the rows of its two children
+        labels, counts = np.unique(dataset[:, -1].astype(int), return_counts=True)
+        assert tree.root.class_counts == dict(zip(labels.tolist(), counts.tolist()))
+        for node in tree_nodes(tree.root):
+            if node.label == None:
+                for label in labels.tolist():
+                    assert node.class_counts.get(label, 0) == (node.left.class_counts.get(label, 0) +
+                                                               node.right.class_counts.get(label, 0))
+
+
+def test_incremental_update_splits_leaves_and_rejects_unknown_labels():
+    dataset = np.array(sc.clean_dataset)[sc.fold_order(2000, 10, 0)]
+    tree = sc.incremental_tree_learning(dataset[:10], classes=[1, 2, 3, 4], batch_tree=False, grace_period=50,
+                                        delta=1e-3)
+    splits = sum(tree.update(dataset[start:start + 100]) for start in range(10, 1800, 100))
+    assert splits > 0 and len(tree_nodes(tree.root)) == 2 * splits + 1
+    assert sc.evaluate_accuracy(tree.root, dataset[1800:]) > 0.7
+    with pytest.raises(ValueError):
+        tree.update(np.array([[-60.0] * 7 + [9.0]]))
+
+
+def test_confusion_metrics_match_a_hand_computed_matrix():
+    # rows are true and columns predicted labels, class 7 is predicted once but never true
+    truth = np.array([1] * 6 + [3] * 6)
+    predictions = np.array([1, 1, 1, 1, 1, 3, 1, 1, 3, 3, 3, 7])
+    confusion_matrix = sc.confusion_matrix_from_labels(truth, predictions, np.array([1, 3, 7]))
+    assert confusion_matrix.tolist() == [[5, 1, 0], [2, 3, 1], [0, 0, 0]]
+
+    metrics = sc.confusion_metrics(confusion_matrix)
+    assert np.isclose(metrics["accuracy"], 8 / 12) and metrics["micro_f1"] == metrics["accuracy"]
+    assert np.allclose(metrics["precision"], [5 / 7, 3 / 4, 0])
+    assert np.allclose(metrics["recall"], [5 / 6, 3 / 6, np.nan], equal_nan=True)
+    assert np.allclose(metrics["f1"], [10 / 13, 3 / 5, np.nan], equal_nan=True)
+    assert np.isclose(metrics["macro_precision"], (5 / 7 + 3 / 4) / 3)
+    assert np.isclose(metrics["macro_recall"], 2 / 3)
+    assert np.isclose(metrics["macro_f1"], (10 / 13 + 3 / 5) / 2)
+
+    # a stack of folds gives the metrics of each fold, fold_metrics their mean and variance
+    folds = np.stack([confusion_matrix, np.diag([2, 2, 2])])
+    assert np.allclose(sc.confusion_metrics(folds)["accuracy"], [8 / 12, 1])
+    summary = sc.fold_metrics(folds)
+    assert np.isclose(summary["accuracy"]["mean"], (8 / 12 + 1) / 2)
+    assert np.isclose(summary["accuracy"]["var"], ((1 - 8 / 12) / 2) ** 2)
+
+
+def test_cost_complexity_path_matches_every_subtree():
+    for dataset in datasets():
+        dataset = dataset[sc.fold_order(len(dataset), 10, 0)]
+        tree = sc.decision_tree_learning(dataset[:1600].copy(), 0)
+        original = copy.deepcopy(tree)
+        validation_set, test = dataset[1600:1800], dataset[1800:]
+        path = sc.cost_complexity_path(tree, validation_set, np.array([1, 2, 3, 4]))
+        confusion_matrices = path.confusion_matrices(test)
+
+        assert np.all(np.diff(path.alphas) >= 0) and path.n_leaves[-1] == 1
+        for i in range(len(path.alphas)):
+            subtree = path.tree(i)
+            leaves = [node for node in tree_nodes(subtree) if node.label != None]
+            assert path.n_leaves[i] == len(leaves)
+            assert path.train_errors[i] == sum(sum(node.class_counts.values()) - node.class_counts.get(node.label, 0)
+                                               for node in leaves)
+            assert np.array_equal(confusion_matrices[i], sc.calculate_confusion_matrix(test, subtree, path.classes))
+            assert path.validation_errors[i] == len(validation_set) - round(
+                sc.evaluate_accuracy(subtree, validation_set) * len(validation_set))
+        assert first_difference(path.tree(0), original) is None
+
+        # the path and its subtrees leave the tree it was computed from as it was
+        assert first_difference(tree, original) is None
+        assert [node.class_counts for node in tree_nodes(tree)] == [node.class_counts for node in tree_nodes(original)]
+
+
+def test_tenfold_uses_seeded_folds_without_shuffling():
+    dataset = np.array(sc.noisy_dataset)
+    original = dataset.copy()
+    average_cf, _ = sc.tenfold(dataset, seed=3)
+    assert np.array_equal(dataset, original)
+
+    # the same folds cut from the dataset shuffled by the fold order
+    shuffled = dataset[sc.fold_order(len(dataset), 10, 3)]
+    schema = sc.DatasetSchema(dataset)
+    bounds = sc.fold_bounds(len(dataset), 10)
+    total = 0
+    for i in range(10):
+        train = np.append(shuffled[:bounds[i]], shuffled[bounds[i+1]:], axis=0)
+        tree = sc.decision_tree_learning(train, 0)
+        total = total + sc.calculate_confusion_matrix(shuffled[bounds[i]:bounds[i+1]], tree, schema.classes)
+    assert np.array_equal(average_cf, total / 10)
+
+
+def test_stratified_folds_are_a_permutation():
+    labels = np.arange(1003) % 3
+    order = sc.fold_order(len(labels), 10, 0, labels)
+    assert np.array_equal(np.sort(order), np.arange(len(labels)))
+    bounds = sc.fold_bounds(len(labels), 10)
+    for i in range(10):
+        counts = np.bincount(labels[order[bounds[i]:bounds[i+1]]], minlength=3)
+        assert counts.max() - counts.min() <= 1
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")